@@ -0,0 +1,38 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+
+
+# Threads running the queries of async views. Each query checks out its own
+# pooled connection, so the pool needs at least this many extra connections.
+MAX_WORKERS = 8
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="adb")
+
+
+def _fetch(name, args, one):
+    with db.connection() as c:
+        cursor = db.run_on(c, name, args)
+        return cursor.fetchone() if one else cursor.fetchall()
+
+
+async def fetchone(name, args=None):
+    # Runs the named query of queries.py
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, _fetch, name, args, True)
+
+
+async def fetchall(name, args=None):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, _fetch, name, args, False)
+
+
+async def gather(*queries):
+    """
+    Runs independent queries at the same time, eg.
+        crime, total = await adb.gather(
+            adb.fetchone("crime", [id]), adb.fetchone("crime_total", [id])
+        )
+    """
+    return await asyncio.gather(*queries)
@@ -0,0 +1,44 @@
+import logging
+from sqlite3 import Connection
+
+
+# Summary tables read by the ranking pages, rebuilt by write_to_db.py after
+# every import. name -> (columns, query)
+TABLES = {
+    # /top_areas/
+    "stats_areas": (
+        "areaId INTEGER PRIMARY KEY, nome TEXT, count INTEGER",
+        """
+        SELECT areaId, nome, COUNT(*)
+        FROM areas JOIN ocorrencias USING (areaId)
+        GROUP BY areaId
+        """,
+    ),
+    # /top_armas/<id>, /blade_crimes/
+    "stats_crime_arma": (
+        "crimeId INTEGER, armaId INTEGER, count INTEGER, PRIMARY KEY (crimeId, armaId)",
+        """
+        SELECT crimeId, armaId, COUNT(*)
+        FROM occ_crime NATURAL JOIN ocorrencias NATURAL JOIN armas
+        GROUP BY crimeId, armaId
+        """,
+    ),
+    # /top_descendencia/<id>
+    "stats_crime_descendencia": (
+        "crimeId INTEGER, descendencia TEXT, count INTEGER, PRIMARY KEY (crimeId, descendencia)",
+        """
+        SELECT crimeId, descendencia, COUNT(*)
+        FROM occ_crime NATURAL JOIN ocorrencias NATURAL JOIN vitimas
+          NATURAL JOIN descendencias
+        GROUP BY crimeId, descendencia
+        """,
+    ),
+}
+
+
+def refresh(con: Connection):
+    for name, (columns, query) in TABLES.items():
+        logging.info(f"Creating {name}...")
+        con.execute(f"DROP TABLE IF EXISTS {name}")
+        con.execute(f"CREATE TABLE {name} ({columns}) WITHOUT ROWID")
+        con.execute(f"INSERT INTO {name} {query}")
@@ -0,0 +1,247 @@
+from datetime import datetime
+import json
+
+from flask import Blueprint, Response, abort, jsonify, request, stream_with_context
+import columnar
+import db
+import pagination
+import rollups
+import spatial
+
+
+API = Blueprint("api", __name__, url_prefix="/api")
+
+# Rows fetched from sqlite at a time while streaming a response
+BATCH = 1000
+
+
+def stream(cursor):
+    """
+    Streams the rows of a cursor as a JSON array, or as one JSON object per
+    line with ?format=ndjson (or Accept: application/x-ndjson). Only BATCH
+    rows are held in memory at a time.
+    """
+    ndjson = (
+        request.args.get("format") == "ndjson"
+        or request.accept_mimetypes.best == "application/x-ndjson"
+    )
+
+    def rows():
+        while True:
+            batch = cursor.fetchmany(BATCH)
+            if not batch:
+                return
+            for row in batch:
+                yield json.dumps(dict(row), ensure_ascii=False)
+
+    def as_ndjson():
+        for row in rows():
+            yield row + "\n"
+
+    def as_array():
+        sep = "["
+        for row in rows():
+            yield sep + row
+            sep = ","
+        yield "[]" if sep == "[" else "]"
+
+    if ndjson:
+        return Response(
+            stream_with_context(as_ndjson()), mimetype="application/x-ndjson"
+        )
+    return Response(stream_with_context(as_array()), mimetype="application/json")
+
+
+@API.route("/areas/<int:id>/ocorrencias")
+def ocorrencias_by_area(id):
+    if db.run("api_area_exists", [id]).fetchone() is None:
+        abort(404, "Area id {} não existe.".format(id))
+
+    return stream(db.run("api_area_ocorrencias", [id]))
+
+
+@API.route("/crimes/<int:id>/ocorrencias")
+def ocorrencias_by_crime(id):
+    if db.run("api_crime_exists", [id]).fetchone() is None:
+        abort(404, "Crime id {} não existe.".format(id))
+
+    return stream(db.run("api_crime_ocorrencias", [id]))
+
+
+@API.route("/armas/<int:id>/ocorrencias")
+def ocorrencias_by_arma(id):
+    if db.run("api_arma_exists", [id]).fetchone() is None:
+        abort(404, "Arma id {} não existe.".format(id))
+
+    return stream(db.run("api_arma_ocorrencias", [id]))
+
+
+def _float_args(*names):
+    try:
+        return [float(request.args[name]) for name in names]
+    except (KeyError, ValueError):
+        abort(400, "Parâmetros obrigatórios: {}.".format(", ".join(names)))
+
+
+@API.route("/ocorrencias/box")
+def ocorrencias_in_box():
+    # ?min_lat=&min_lon=&max_lat=&max_lon=[&since=YYYY-MM-DD][&until=YYYY-MM-DD]
+    box = _float_args("min_lat", "min_lon", "max_lat", "max_lon")
+    try:
+        args = spatial.box(*box, request.args.get("since"), request.args.get("until"))
+    except ValueError:
+        abort(400, "Área ou datas inválidas.")
+
+    return stream(db.run("spatial_box", args))
+
+
+@API.route("/ocorrencias/near")
+def ocorrencias_near():
+    # ?lat=&lon=&radius=<meters>[&since=YYYY-MM-DD][&until=YYYY-MM-DD]
+    circle = _float_args("lat", "lon", "radius")
+    try:
+        args = spatial.near(
+            *circle, request.args.get("since"), request.args.get("until")
+        )
+    except ValueError:
+        abort(400, "Círculo ou datas inválidos.")
+
+    return stream(db.run("spatial_near", args))
+
+
+def series(name):
+    """
+    Rows of a rollup for the request's ?id=&since=&until=&group=, aborting
+    with 400/404 on bad arguments. Returns (group, rows).
+    """
+    if name not in rollups.ROLLUPS:
+        abort(404, "Série {} não existe.".format(name))
+    group = request.args.get("group") or rollups.groups(name)[0]
+    if group not in rollups.groups(name):
+        abort(400, "Agrupamentos: {}.".format(", ".join(rollups.groups(name))))
+    try:
+        id = request.args.get("id") or None
+        id = int(id) if id is not None else None
+    except ValueError:
+        abort(400, "Id inválido, use um número inteiro.")
+    try:
+        since = request.args.get("since") or None
+        until = request.args.get("until") or None
+        args = rollups.series_args(name, since, until)
+    except ValueError:
+        abort(400, "Datas inválidas, use AAAA-MM-DD.")
+
+    if id is None:
+        rows = db.run(f"series:{name}:{group}:all", args).fetchall()
+    else:
+        rows = db.run(f"series:{name}:{group}:one", [id, *args]).fetchall()
+    return group, rows
+
+
+@API.route("/series/<name>")
+def series_json(name):
+    # ?[id=][&since=YYYY-MM-DD][&until=YYYY-MM-DD][&group=]
+    group, rows = series(name)
+    return jsonify(
+        name=name,
+        group=group,
+        id=request.args.get("id", type=int),
+        series=[dict(row) for row in rows],
+    )
+
+
+# Keys the columnar queries can filter and count by
+KEYS = ["areaId", "crimeId", "armaId", "localId", "sexoId", "descendenciaId"]
+
+# Keys counted alongside the occurrences of /ocorrencias/filter
+FACETS = ["areaId", "crimeId", "armaId", "sexoId", "descendenciaId"]
+
+
+def snapshot():
+    snapshot = columnar.get()
+    if snapshot is None:
+        abort(503, "Snapshot colunar indisponível, execute write_to_db.py.")
+    return snapshot
+
+
+def filters():
+    """
+    Arguments of columnar.select() from the request: any of KEYS (repeatable),
+    idade_min, idade_max, since and until (YYYY-MM-DD).
+    """
+    try:
+        args = {key: [int(v) for v in request.args.getlist(key)] for key in KEYS}
+        args["idade"] = tuple(
+            None if request.args.get(name) in (None, "") else int(request.args[name])
+            for name in ("idade_min", "idade_max")
+        )
+    except ValueError:
+        abort(400, "Filtros inválidos, use números inteiros.")
+    for name in ("since", "until"):
+        args[name] = request.args.get(name) or None
+        try:
+            if args[name] is not None:
+                datetime.strptime(args[name], "%Y-%m-%d")
+        except ValueError:
+            abort(400, "Datas inválidas, use AAAA-MM-DD.")
+    return args
+
+
+@API.route("/counts/<by>")
+def counts(by):
+    # Occurrences per key, ?[top=] and any of filters()
+    if by not in KEYS and by != "idade":
+        abort(404, "Agrupamentos: {}.".format(", ".join(KEYS + ["idade"])))
+    s = snapshot()
+    rows = columnar.count(
+        s, by, columnar.select(s, **filters()), request.args.get("top", type=int)
+    )
+    return jsonify(
+        by=by,
+        counts=[{by: code, "nome": label, "count": n} for code, label, n in rows],
+    )
+
+
+def filtered():
+    """
+    Occurrences matching filters() for /ocorrencias/filter, newest first and
+    paginated like /ocorrencias/, along with their total and the FACETS
+    counts. The matching is done on the columnar snapshot, only the rows of
+    the page are read from the database.
+    """
+    s = snapshot()
+    per_page, after, before = pagination.page_args(2)
+    args = filters()
+    selected = columnar.select(s, **args)
+    try:
+        ids = columnar.page(s, selected, per_page + 1, after, before)
+    except (TypeError, ValueError):
+        abort(400, "Cursor de paginação inválido.")
+    rows = {row["occId"]: row for row in db.run("ocorrencias:ids", [json.dumps(ids)])}
+    ocorrencias, next, prev = pagination.paginate(
+        [rows[id] for id in ids if id in rows],
+        per_page,
+        key=lambda o: (o["date_occ"], o["occId"]),
+        after=after,
+        before=before,
+    )
+    facets = {
+        key: [{key: code, "nome": label, "count": n} for code, label, n in rows]
+        for key, rows in columnar.facets(s, FACETS, **args).items()
+    }
+    return dict(
+        total=columnar.total(s, selected),
+        facets=facets,
+        ocorrencias=ocorrencias,
+        per_page=per_page,
+        next=next,
+        prev=prev,
+    )
+
+
+@API.route("/ocorrencias/filter")
+def ocorrencias_filter():
+    # Any of filters(), ?[per_page=][&after=|&before=]
+    page = filtered()
+    page["ocorrencias"] = [dict(row) for row in page["ocorrencias"]]
+    return jsonify(page)
@@ -2,282 +2,226 @@ import warnings
 
 warnings.filterwarnings("ignore", category=FutureWarning)
 from flask import abort, render_template, Flask, request
+from urllib.parse import urlencode
 import logging
+import os
+import adb
+import api
+import cache
+import dashboard
 import db
+import fts
+import metrics
+import ocorrencia
+import pagination
+import rollups
 
 APP = Flask(__name__)
+APP.config["ASYNC_VIEWS"] = os.environ.get("ASYNC_VIEWS") == "1"
+APP.register_blueprint(api.API)
+db.init_app(APP)
+metrics.init_app(APP)
+cache.init_app(APP)
+
+# Headings of the facets of /ocorrencias/filter
+FACET_LABELS = {
+    "areaId": "Área",
+    "crimeId": "Crime",
+    "armaId": "Arma",
+    "sexoId": "Sexo",
+    "descendenciaId": "Descendência",
+}
+
+
+def _page_query(name, args):
+    # The variant of a page query of queries.py for the request's cursor
+    per_page, after, before = pagination.page_args(2)
+    if after is not None:
+        name, args = name + ":after", [*args, *after, per_page + 1]
+    elif before is not None:
+        name, args = name + ":before", [*args, *before, per_page + 1]
+    else:
+        name, args = name + ":first", [*args, per_page + 1]
+    return name, args, per_page, after, before
+
+
+def _page(rows, per_page, after, before):
+    ocorrencias, next, prev = pagination.paginate(
+        rows,
+        per_page,
+        key=lambda o: (o["date_occ"], o["occId"]),
+        after=after,
+        before=before,
+    )
+    return dict(ocorrencias=ocorrencias, per_page=per_page, next=next, prev=prev)
+
+
+def ocorrencias_page(name, args):
+    """
+    One page of the occurrences selected by the named query, sorted by
+    date_occ. name is one of the pages of queries.py, which come in a
+    variant for the first page and for seeking after or before a cursor.
+    """
+    name, args, per_page, after, before = _page_query(name, args)
+    return _page(db.run(name, args).fetchall(), per_page, after, before)
+
+
+async def ocorrencias_page_async(name, args):
+    # ocorrencias_page() for the async views
+    name, args, per_page, after, before = _page_query(name, args)
+    return _page(await adb.fetchall(name, args), per_page, after, before)
 
 
 # Start page
 @APP.route("/")
 def index():
-    stats = {}
-    stats = db.execute(
-        """
-    SELECT * FROM
-      (SELECT COUNT() n_occur FROM Ocorrencias)
-    JOIN
-      (SELECT COUNT() n_armas FROM Armas)
-    JOIN
-      (SELECT COUNT() n_areas FROM Areas)
-    JOIN
-      (SELECT COUNT() n_locais FROM Locais)
-    JOIN
-      (SELECT COUNT() n_vitimas FROM Vitimas)
-    JOIN
-      (SELECT COUNT() n_crimes FROM Crimes)
-    """
-    ).fetchone()
-    logging.info(stats)
+    stats = dashboard.get()
     return render_template("index.html", stats=stats)
 
 
 # Rankings
 @APP.route("/top_areas/")
 def top_areas():
-    stats = db.execute(
-        """
-    select nome as area, count(*) as count
-    from areas natural join locais natural join ocorrencias
-    group by areaId
-    order by count desc
-    limit 5;
-    """
-    ).fetchall()
+    stats = db.run("top_areas").fetchall()
     return render_template("top-areas.html", stats=stats)
 
 
 @APP.route("/top_armas/<int:id>")
 def top_armas(id):
-    crime = db.execute(
-        """
-        select desc_crime as crime
-        from crimes
-        where crimeId = ?
-        """,
-        [id],
-    ).fetchone()
+    crime = db.run("crime_name", [id]).fetchone()
 
     if crime is None:
         abort(404, "Crime id {} não existe.".format(id))
 
-    stats = db.execute(
-        """
-    select desc_arma as arma, count(*) as count
-    from crimes natural join occ_crime natural join ocorrencias natural join armas
-    where crimeId = ?
-    group by armaId
-    order by count desc
-    limit 10;
-    """,
-        [id],
-    ).fetchall()
+    stats = db.run("top_armas", [id]).fetchall()
 
     return render_template("top-armas.html", crime=crime, stats=stats)
 
 
 @APP.route("/top_descendencia/<int:id>")
 def top_descendencia(id):
-    crime = db.execute(
-        """
-        select desc_crime as crime
-        from crimes
-        where crimeId = ?
-        """,
-        [id],
-    ).fetchone()
+    crime = db.run("crime_name", [id]).fetchone()
 
     if crime is None:
         abort(404, "Crime id {} não existe.".format(id))
 
-    stats = db.execute(
-        """
-        select count(*) as count, descendencia
-        from crimes natural join occ_crime natural join ocorrencias natural join vitimas
-        where crimeId = ?
-        group by descendencia
-        order by count desc
-        limit 3;
-        """,
-        [id],
-    ).fetchall()
+    stats = db.run("top_descendencia", [id]).fetchall()
 
     return render_template("top-descendencia.html", crime=crime, stats=stats)
 
 
 @APP.route("/blade_crimes/")
 def blade_crimes():
-    stats = db.execute(
-        """
-    SELECT crimeId, desc_crime, desc_arma
-    FROM armas natural join ocorrencias natural join occ_crime natural join crimes
-    where (armaId<211 and armaId>199) or (armaId=216)
-    group by crimeId;
-    """
-    ).fetchall()
+    stats = db.run("blade_crimes").fetchall()
     logging.info(stats)
     return render_template("blade-crimes.html", stats=stats)
 
 
+# Time series
+@APP.route("/series/")
+def view_series():
+    name = request.args.get("name", "day_area")
+    group, rows = api.series(name)
+    return render_template(
+        "series.html",
+        name=name,
+        group=group,
+        groups=rollups.groups(name),
+        rollups=rollups.ROLLUPS,
+        rows=rows,
+        peak=max((row["count"] for row in rows), default=0),
+        args=request.args,
+    )
+
+
 # Ocorrencias
 @APP.route("/ocorrencias/")
 def list_ocorrencias():
-    page = request.args.get("page", default=0, type=int)
-    per_page = request.args.get("per_page", default=100, type=int)
-    ocorrencias = db.execute(
-        """
-      SELECT occId, localId, armaId, vitimaId, date_occ, date_rptd
-      FROM ocorrencias
-      ORDER BY date_occ desc
-      LIMIT :per_page OFFSET :page * :per_page
-      """,
-        {"per_page": per_page, "page": page},
-    ).fetchall()
+    per_page, after, before = pagination.page_args(2)
+    if after is not None:
+        name, args = "ocorrencias:after", [*after, per_page + 1]
+    elif before is not None:
+        name, args = "ocorrencias:before", [*before, per_page + 1]
+    else:
+        name, args = "ocorrencias:first", [per_page + 1]
+
+    ocorrencias, next, prev = pagination.paginate(
+        db.run(name, args).fetchall(),
+        per_page,
+        key=lambda o: (o["date_occ"], o["occId"]),
+        after=after,
+        before=before,
+    )
+    return render_template(
+        "ocorrencias-list.html",
+        ocorrencias=ocorrencias,
+        per_page=per_page,
+        next=next,
+        prev=prev,
+    )
+
+
+@APP.route("/ocorrencias/filter")
+def filter_ocorrencias():
+    page = api.filtered()
+    # Filters of the request, kept by the facet and pagination links
+    query = urlencode(
+        [
+            (k, v)
+            for k, v in request.args.items(multi=True)
+            if k not in ("after", "before")
+        ]
+    )
     return render_template(
-        "ocorrencias-list.html", ocorrencias=ocorrencias, page=page, per_page=per_page
+        "ocorrencias-filter.html",
+        labels=FACET_LABELS,
+        query=query,
+        args=request.args,
+        **page,
     )
 
 
 @APP.route("/ocorrencias/<int:id>/")
 def get_ocorrencia(id):
-    ocorrencias = db.execute(
-        """
-      SELECT occId, date_occ, date_rptd
-      FROM Ocorrencias
-      WHERE occId = ?
-      """,
-        [id],
-    ).fetchone()
-
-    if ocorrencias is None:
-        abort(404, "Ocorrencia com id {} não existe.".format(id))
+    record = ocorrencia.get(id)
 
-    crimes = db.execute(
-        """
-      SELECT crimeId, crimes.desc_crime
-      FROM ocorrencias NATURAL JOIN occ_crime NATURAL JOIN crimes
-      WHERE occId = ?
-      ORDER BY crimeId
-      """,
-        [id],
-    ).fetchone()
-
-    vitimas = db.execute(
-        """
-      SELECT vitimaId, idade, sexo, descendencia
-      FROM Ocorrencias NATURAL JOIN vitimas
-      WHERE occId = ?
-      ORDER BY vitimaId
-      """,
-        [id],
-    ).fetchone()
-
-    areas = db.execute(
-        """
-      SELECT areaId, nome
-      FROM Ocorrencias NATURAL JOIN Locais NATURAL JOIN Areas
-      WHERE occId = ?
-      ORDER BY areaId
-      """,
-        [id],
-    ).fetchone()
-
-    locais = db.execute(
-        """
-      SELECT localId, desc_local, nome as area, coordenadas, morada
-      FROM Ocorrencias NATURAL JOIN Locais NATURAL JOIN Areas
-      WHERE occId = ?
-      ORDER BY localId
-      """,
-        [id],
-    ).fetchone()
-
-    armas = db.execute(
-        """
-      SELECT armaId, desc_arma
-      FROM Ocorrencias NATURAL JOIN Armas
-      WHERE occId = ?
-      ORDER BY armaId
-      """,
-        [id],
-    ).fetchone()
+    if record is None:
+        abort(404, "Ocorrencia com id {} não existe.".format(id))
 
-    return render_template(
-        "ocorrencia.html",
-        ocorrencias=ocorrencias,
-        crimes=crimes,
-        vitimas=vitimas,
-        areas=areas,
-        locais=locais,
-        armas=armas,
-    )
+    return render_template("ocorrencia.html", **record)
 
 
 # Areas
 @APP.route("/areas/")
 def list_areas():
-    areas = db.execute(
-        """
-      SELECT areaId, nome
-      FROM Areas
-      ORDER BY areaId
-    """
-    ).fetchall()
+    areas = db.run("areas").fetchall()
     return render_template("areas-list.html", areas=areas)
 
 
 @APP.route("/areas/<int:id>/")
 def view_ocorriencias_by_area(id):
-    area = db.execute(
-        """
-    SELECT areaId, nome
-    FROM Areas
-    WHERE areaId = ?
-    ORDER BY nome
-    """,
-        [id],
-    ).fetchone()
+    area = db.run("area", [id]).fetchone()
 
     if area is None:
         abort(404, "Area id {} não existe.".format(id))
 
-    locais = db.execute(
-        """
-    SELECT localId, desc_local
-    FROM Areas NATURAL JOIN Locais
-    WHERE areaId = ?
-    ORDER by localId
-    """,
-        [id],
-    ).fetchall()
-
-    ocorrencias = db.execute(
-        """
-    SELECT occId, date_occ, date_rptd
-    FROM Ocorrencias NATURAL JOIN Locais NATURAL JOIN Areas
-    WHERE areaId = ?
-    ORDER BY date_occ
-    """,
-        [id],
-    ).fetchall()
+    locais = db.run("area_locais", [id]).fetchall()
+    total = db.run("area_total", [id]).fetchone()
+    page = ocorrencias_page("area_ocorrencias", [id])
 
     return render_template(
-        "area.html", area=area, ocorrencias=ocorrencias, locais=locais
+        "area.html",
+        area=area,
+        locais=locais,
+        total=total["count"] if total else 0,
+        **page,
     )
 
 
 @APP.route("/areas/search/<expr>/")
 def search_area(expr):
     search = {"expr": expr}
-    expr = "%" + expr + "%"
-    area = db.execute(
-        """ SELECT areaId, nome
-        FROM Areas
-        WHERE nome like ?
-        ORDER BY nome
-        """,
-        [expr],
-    ).fetchall()
+    area = fts.search("areas_fts", expr)
 
     return render_template("area-search.html", search=search, area=area)
 
@@ -285,54 +229,27 @@ def search_area(expr):
 # Crimes
 @APP.route("/crimes/")
 def list_crimes():
-    crimes = db.execute(
-        """
-      SELECT crimeId, desc_crime
-      FROM Crimes
-      ORDER BY crimeId
-    """
-    ).fetchall()
+    crimes = db.run("crimes").fetchall()
     return render_template("crime-list.html", crimes=crimes)
 
 
 @APP.route("/crimes/<int:id>/")
 def view_ocorriencias_by_crime(id):
-    crime = db.execute(
-        """
-    SELECT crimeId, desc_crime
-    FROM Crimes
-    WHERE crimeId = ?
-    """,
-        [id],
-    ).fetchone()
+    crime = db.run("crime", [id]).fetchone()
 
     if crime is None:
         abort(404, "Crime id {} não existe.".format(id))
 
-    ocorrencias = db.execute(
-        """
-    SELECT occID, date_occ, date_rptd
-    FROM Ocorrencias NATURAL JOIN occ_crime NATURAL JOIN Crimes
-    WHERE crimeId = ?
-    ORDER BY date_occ
-    """,
-        [id],
-    ).fetchall()
+    total = db.run("crime_total", [id]).fetchone()
+    page = ocorrencias_page("crime_ocorrencias", [id])
 
-    return render_template("crime.html", crime=crime, ocorrencias=ocorrencias)
+    return render_template("crime.html", crime=crime, total=total[0], **page)
 
 
 @APP.route("/crimes/search/<expr>/")
 def search_crime(expr):
     search = {"expr": expr}
-    expr = "%" + expr + "%"
-    crimes = db.execute(
-        """ SELECT crimeId, desc_crime
-        FROM Crimes
-        WHERE desc_crime like ?
-        """,
-        [expr],
-    ).fetchall()
+    crimes = fts.search("crimes_fts", expr)
 
     return render_template("crime-search.html", search=search, crimes=crimes)
 
@@ -340,55 +257,27 @@ def search_crime(expr):
 # Locais
 @APP.route("/locais/")
 def list_locais():
-    locais = db.execute(
-        """
-      SELECT localId, coordenadas, morada, desc_local, areaId
-      FROM Locais NATURAL JOIN Areas
-      ORDER BY desc_local
-    """
-    ).fetchall()
+    locais = db.run("locais").fetchall()
     return render_template("local-list.html", locais=locais)
 
 
 @APP.route("/locais/<int:id>/")
 def view_ocorrencias_by_local(id):
-    local = db.execute(
-        """
-    SELECT localId, coordenadas, morada, desc_local, areaId
-    FROM Locais
-    WHERE localId = ?
-    """,
-        [id],
-    ).fetchone()
+    local = db.run("local", [id]).fetchone()
 
     if local is None:
         abort(404, "Local id {} não existe.".format(id))
 
-    ocorrencias = db.execute(
-        """
-    SELECT occId
-    FROM Ocorrencias NATURAL JOIN Locais NATURAL JOIN Areas
-    WHERE localId = ?
-    ORDER BY localId
-    """,
-        [id],
-    ).fetchall()
+    total = db.run("local_total", [id]).fetchone()
+    page = ocorrencias_page("local_ocorrencias", [id])
 
-    return render_template("local.html", local=local, ocorrencias=ocorrencias)
+    return render_template("local.html", local=local, total=total[0], **page)
 
 
 @APP.route("/locais/search/<expr>/")
 def search_local_by_desc(expr):
     search = {"expr": expr}
-    expr = "%" + expr + "%"
-    local = db.execute(
-        """
-        SELECT localId, coordenadas, morada, desc_local
-        FROM Locais
-        WHERE desc_local like ?
-        """,
-        [expr],
-    ).fetchall()
+    local = fts.search("locais_fts", expr, column="desc_local")
 
     return render_template("local-search.html", search=search, local=local)
 
@@ -396,15 +285,7 @@ def search_local_by_desc(expr):
 @APP.route("/locais/search-morada/<expr>/")
 def search_local_by_morada(expr):
     search = {"expr": expr}
-    expr = "%" + expr + "%"
-    local = db.execute(
-        """
-        SELECT localId, coordenadas, morada, desc_local
-        FROM Locais
-        WHERE morada like ?
-        """,
-        [expr],
-    ).fetchall()
+    local = fts.search("locais_fts", expr, column="morada")
 
     return render_template("local-search-morada.html", search=search, local=local)
 
@@ -412,100 +293,151 @@ def search_local_by_morada(expr):
 # Vitimas
 @APP.route("/vitimas/")
 def list_vitimas():
-    page = request.args.get("page", default=0, type=int)
-    per_page = request.args.get("per_page", default=100, type=int)
-    vitimas = db.execute(
-        """
-      SELECT vitimaId, idade, sexo, descendencia
-      FROM Vitimas
-      order by vitimaId
-      LIMIT :per_page OFFSET :page * :per_page
-      """,
-        {"per_page": per_page, "page": page},
-    ).fetchall()
+    per_page, after, before = pagination.page_args(1)
+    if after is not None:
+        name, args = "vitimas:after", [*after, per_page + 1]
+    elif before is not None:
+        name, args = "vitimas:before", [*before, per_page + 1]
+    else:
+        name, args = "vitimas:first", [per_page + 1]
+
+    vitimas, next, prev = pagination.paginate(
+        db.run(name, args).fetchall(),
+        per_page,
+        key=lambda v: (v["vitimaId"],),
+        after=after,
+        before=before,
+    )
     return render_template(
-        "vitimas-list.html", vitimas=vitimas, per_page=per_page, page=page
+        "vitimas-list.html", vitimas=vitimas, per_page=per_page, next=next, prev=prev
     )
 
 
 @APP.route("/vitimas/<int:id>/")
 def view_ocorriencias_by_vitima(id):
-    vitima = db.execute(
-        """
-    SELECT vitimaId, idade, sexo, descendencia
-    FROM Vitimas
-    WHERE vitimaId = ?
-    """,
-        [id],
-    ).fetchone()
+    vitima = db.run("vitima", [id]).fetchone()
 
     if vitima is None:
         abort(404, "Vítima id {} não existe.".format(id))
 
-    ocorrencias = db.execute(
-        """
-    SELECT occID, date_occ, date_rptd
-    FROM Ocorrencias NATURAL JOIN Vitimas
-    WHERE vitimaId = ?
-    ORDER BY date_occ
-    """,
-        [id],
-    ).fetchall()
+    total = db.run("vitima_total", [id]).fetchone()
+    page = ocorrencias_page("vitima_ocorrencias", [id])
 
-    return render_template("vitima.html", vitima=vitima, ocorrencias=ocorrencias)
+    return render_template("vitima.html", vitima=vitima, total=total[0], **page)
 
 
 # Armas
 @APP.route("/armas/")
 def list_armas():
-    armas = db.execute(
-        """
-      SELECT armaId, desc_arma
-      FROM Armas
-      ORDER BY armaId
-    """
-    ).fetchall()
+    armas = db.run("armas").fetchall()
     return render_template("armas-list.html", armas=armas)
 
 
 @APP.route("/armas/<int:id>/")
 def view_ocorriencias_by_arma(id):
-    arma = db.execute(
-        """
-    SELECT armaId, desc_arma
-    FROM  Armas
-    WHERE armaId = ?
-    ORDER BY armaId
-    """,
-        [id],
-    ).fetchone()
+    arma = db.run("arma", [id]).fetchone()
 
     if arma is None:
         abort(404, "Arma id {} não existe.".format(id))
 
-    ocorrencias = db.execute(
-        """
-    SELECT occId, date_occ, date_rptd
-    FROM Ocorrencias NATURAL JOIN Armas
-    WHERE armaId = ?
-    ORDER BY date_occ
-    """,
-        [id],
-    ).fetchall()
+    total = db.run("arma_total", [id]).fetchone()
+    page = ocorrencias_page("arma_ocorrencias", [id])
 
-    return render_template("arma.html", arma=arma, ocorrencias=ocorrencias)
+    return render_template("arma.html", arma=arma, total=total[0], **page)
 
 
 @APP.route("/armas/search/<expr>/")
 def search_arma(expr):
     search = {"expr": expr}
-    expr = "%" + expr + "%"
-    arma = db.execute(
-        """ SELECT armaId, desc_arma
-        FROM Armas
-        WHERE desc_arma like ?
-        """,
-        [expr],
-    ).fetchall()
+    arma = fts.search("armas_fts", expr)
 
     return render_template("arma-search.html", search=search, arma=arma)
+
+
+# Async variants of the detail views, used instead of the ones above with
+# ASYNC_VIEWS=1. They run their independent queries at the same time on adb's
+# threads, which only pays off when the queries take longer than the event
+# loop and thread hand-offs around them, see README.md.
+
+
+async def view_ocorriencias_by_area_async(id):
+    area, locais, total, page = await adb.gather(
+        adb.fetchone("area", [id]),
+        adb.fetchall("area_locais", [id]),
+        adb.fetchone("area_total", [id]),
+        ocorrencias_page_async("area_ocorrencias", [id]),
+    )
+
+    if area is None:
+        abort(404, "Area id {} não existe.".format(id))
+
+    return render_template(
+        "area.html",
+        area=area,
+        locais=locais,
+        total=total["count"] if total else 0,
+        **page,
+    )
+
+
+async def view_ocorriencias_by_crime_async(id):
+    crime, total, page = await adb.gather(
+        adb.fetchone("crime", [id]),
+        adb.fetchone("crime_total", [id]),
+        ocorrencias_page_async("crime_ocorrencias", [id]),
+    )
+
+    if crime is None:
+        abort(404, "Crime id {} não existe.".format(id))
+
+    return render_template("crime.html", crime=crime, total=total[0], **page)
+
+
+async def view_ocorrencias_by_local_async(id):
+    local, total, page = await adb.gather(
+        adb.fetchone("local", [id]),
+        adb.fetchone("local_total", [id]),
+        ocorrencias_page_async("local_ocorrencias", [id]),
+    )
+
+    if local is None:
+        abort(404, "Local id {} não existe.".format(id))
+
+    return render_template("local.html", local=local, total=total[0], **page)
+
+
+async def view_ocorriencias_by_vitima_async(id):
+    vitima, total, page = await adb.gather(
+        adb.fetchone("vitima", [id]),
+        adb.fetchone("vitima_total", [id]),
+        ocorrencias_page_async("vitima_ocorrencias", [id]),
+    )
+
+    if vitima is None:
+        abort(404, "Vítima id {} não existe.".format(id))
+
+    return render_template("vitima.html", vitima=vitima, total=total[0], **page)
+
+
+async def view_ocorriencias_by_arma_async(id):
+    arma, total, page = await adb.gather(
+        adb.fetchone("arma", [id]),
+        adb.fetchone("arma_total", [id]),
+        ocorrencias_page_async("arma_ocorrencias", [id]),
+    )
+
+    if arma is None:
+        abort(404, "Arma id {} não existe.".format(id))
+
+    return render_template("arma.html", arma=arma, total=total[0], **page)
+
+
+if APP.config["ASYNC_VIEWS"]:
+    for view in (
+        view_ocorriencias_by_area_async,
+        view_ocorriencias_by_crime_async,
+        view_ocorrencias_by_local_async,
+        view_ocorriencias_by_vitima_async,
+        view_ocorriencias_by_arma_async,
+    ):
+        APP.view_functions[view.__name__[: -len("_async")]] = view
@@ -0,0 +1,52 @@
+#! /usr/bin/python3
+# Times every stage of write_to_db.py and reports rows per second.
+#   python3 bench_loader.py [csv] [--json results.json]
+import argparse
+import json
+import logging
+import os
+import tempfile
+
+import write_to_db
+
+
+def run(csv_path, chunksize=None, workers=1):
+    with tempfile.TemporaryDirectory() as tmp:
+        write_to_db.main(
+            csv_path, os.path.join(tmp, "bench.db"), chunksize, workers=workers
+        )
+    return [
+        {
+            "stage": name,
+            "rows": rows,
+            "seconds": round(seconds, 4),
+            "rows_per_second": round(rows / max(seconds, 1e-9)),
+        }
+        for name, (rows, seconds) in write_to_db.TIMINGS.items()
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time every stage of write_to_db.py")
+    parser.add_argument("csv", nargs="?", default=write_to_db.CSV_PATH)
+    parser.add_argument("--chunksize", type=int, help="benchmark the streaming import")
+    parser.add_argument(
+        "--workers", type=int, default=1, help="benchmark the parallel import"
+    )
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = run(args.csv, args.chunksize, args.workers)
+
+    print("%-28s %10s %10s %12s" % ("stage", "rows", "seconds", "rows/s"))
+    for r in results:
+        print(
+            "%-28s %10d %10.3f %12d"
+            % (r["stage"], r["rows"], r["seconds"], r["rows_per_second"])
+        )
+    print("%-28s %10s %10.3f" % ("total", "", sum(r["seconds"] for r in results)))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
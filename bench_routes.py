@@ -0,0 +1,390 @@
+#! /usr/bin/python3
+# Latency, throughput and memory of every route of app.py over a synthetic
+# database built by write_to_db.py.
+#   python3 bench_routes.py [--rows 100000] [--json results.json]
+#   python3 bench_routes.py --db data.db --baseline results.json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import platform
+import resource
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import write_to_db
+
+# Rows of the synthetic csv generated at a time
+CHUNK = 500_000
+
+# Imports above this many rows stream the csv with this chunksize
+STREAM_ROWS = 2_000_000
+
+# Vocabularies of the synthetic csv, code -> description
+AREAS = {
+    i: name
+    for i, name in enumerate(
+        [
+            "Central", "Rampart", "Southwest", "Hollenbeck", "Harbor", "Hollywood",
+            "Wilshire", "West LA", "Van Nuys", "West Valley", "Northeast",
+            "77th Street", "Newton", "Pacific", "N Hollywood", "Foothill",
+            "Devonshire", "Southeast", "Mission", "Olympic", "Topanga",
+        ],
+        1,
+    )
+}
+CRIMES = {
+    110: "CRIMINAL HOMICIDE",
+    230: "ASSAULT WITH DEADLY WEAPON, AGGRAVATED ASSAULT",
+    310: "BURGLARY",
+    330: "BURGLARY FROM VEHICLE",
+    354: "THEFT OF IDENTITY",
+    440: "THEFT PLAIN - PETTY ($950 & UNDER)",
+    510: "VEHICLE - STOLEN",
+    624: "BATTERY - SIMPLE ASSAULT",
+    740: "VANDALISM - FELONY ($400 & OVER, ALL CHURCH VANDALISMS)",
+    998: "OTHER",
+}
+ARMAS = {
+    102: "HAND GUN",
+    200: "KNIFE WITH BLADE 6INCHES OR LESS",
+    207: "OTHER KNIFE",
+    216: "SWITCH BLADE",
+    400: "STRONG-ARM (HANDS, FIST, FEET OR BODILY FORCE)",
+    500: "UNKNOWN WEAPON/OTHER WEAPON",
+}
+PREMISES = {
+    101: "STREET",
+    102: "SIDEWALK",
+    108: "PARKING LOT",
+    404: "DEPARTMENT STORE",
+    405: "CLOTHING STORE",
+    501: "SINGLE FAMILY DWELLING",
+    502: "MULTI-UNIT DWELLING (APARTMENT, DUPLEX, ETC)",
+}
+STREETS = ["5TH", "MAIN", "BROADWAY", "SUNSET", "FIGUEROA", "VERMONT", "WESTERN"]
+
+# Urls of the routes that take arguments, filled in with samples(). Routes
+# missing here and taking arguments are reported and skipped.
+URLS = {
+    "/top_armas/<int:id>": "/top_armas/{crimeId}",
+    "/top_descendencia/<int:id>": "/top_descendencia/{crimeId}",
+    "/ocorrencias/<int:id>/": "/ocorrencias/{occId}/",
+    "/ocorrencias/filter": "/ocorrencias/filter?areaId={areaId}&crimeId={crimeId}"
+    "&idade_min=18&idade_max=40",
+    "/areas/<int:id>/": "/areas/{areaId}/",
+    "/areas/search/<expr>/": "/areas/search/Hollywood/",
+    "/crimes/<int:id>/": "/crimes/{crimeId}/",
+    "/crimes/search/<expr>/": "/crimes/search/THEFT/",
+    "/locais/<int:id>/": "/locais/{localId}/",
+    "/locais/search/<expr>/": "/locais/search/STREET/",
+    "/locais/search-morada/<expr>/": "/locais/search-morada/MAIN/",
+    "/vitimas/<int:id>/": "/vitimas/{vitimaId}/",
+    "/armas/<int:id>/": "/armas/{armaId}/",
+    "/armas/search/<expr>/": "/armas/search/KNIFE/",
+    "/api/areas/<int:id>/ocorrencias": "/api/areas/{areaId}/ocorrencias",
+    "/api/crimes/<int:id>/ocorrencias": "/api/crimes/{crimeId}/ocorrencias",
+    "/api/armas/<int:id>/ocorrencias": "/api/armas/{armaId}/ocorrencias",
+    "/api/ocorrencias/box": "/api/ocorrencias/box?min_lat={lat}&min_lon={lon}"
+    "&max_lat={lat_1}&max_lon={lon_1}",
+    "/api/ocorrencias/near": "/api/ocorrencias/near?lat={lat}&lon={lon}&radius=500",
+    "/api/series/<name>": "/api/series/day_area?id={areaId}&group=month",
+    "/api/counts/<by>": "/api/counts/armaId?crimeId={crimeId}",
+    "/api/ocorrencias/filter": "/api/ocorrencias/filter?sexoId={sexoId}"
+    "&since=2022-01-01",
+}
+
+
+def synthetic_csv(path, rows, seed=0):
+    """
+    Writes rows random occurrences to path, with the columns of the LA crime
+    csv that write_to_db.py reads.
+    """
+    rng = np.random.default_rng(seed)
+    areas, crimes = np.array(list(AREAS)), np.array(list(CRIMES))
+    armas, premises = np.array(list(ARMAS)), np.array(list(PREMISES))
+    for start in range(0, rows, CHUNK):
+        n = min(CHUNK, rows - start)
+        date = pd.Timestamp("2020-01-01") + pd.to_timedelta(
+            rng.integers(0, 4 * 365, n), unit="D"
+        )
+        area = rng.choice(areas, n)
+        crime = rng.choice(crimes, n)
+        premis = rng.choice(premises, n)
+        arma = pd.array(rng.choice(armas, n), dtype="Int64")
+        arma[rng.random(n) < 0.4] = pd.NA
+        crime_2 = pd.array(np.full(n, 998), dtype="Int64")
+        crime_2[rng.random(n) < 0.9] = pd.NA
+        df = pd.DataFrame(
+            {
+                "DR_NO": np.arange(200_000_000 + start, 200_000_000 + start + n),
+                "Date Rptd": date.strftime("%m/%d/%Y 12:00:00 AM"),
+                "DATE OCC": date.strftime("%m/%d/%Y 12:00:00 AM"),
+                "TIME OCC": rng.integers(0, 24, n) * 100 + rng.integers(0, 60, n),
+                "AREA": area,
+                "AREA NAME": pd.Series(area).map(AREAS),
+                "Crm Cd": crime,
+                "Crm Cd Desc": pd.Series(crime).map(CRIMES),
+                "Vict Age": rng.integers(0, 90, n),
+                "Vict Sex": rng.choice(["M", "F", "X", ""], n),
+                "Vict Descent": rng.choice(list("BHXWAOCKI") + [""], n),
+                "Premis Cd": premis,
+                "Premis Desc": pd.Series(premis).map(PREMISES),
+                "Weapon Used Cd": arma,
+                "Weapon Desc": pd.Series(arma).map(ARMAS),
+                "Crm Cd 1": crime,
+                "Crm Cd 2": crime_2,
+                "LOCATION": [
+                    "{} {} ST".format(number, street)
+                    for number, street in zip(
+                        rng.integers(100, 10_000, n), rng.choice(STREETS, n)
+                    )
+                ],
+                "LAT": np.round(33.7 + rng.random(n) * 0.6, 4),
+                "LON": np.round(-118.6 + rng.random(n) * 0.5, 4),
+            }
+        )
+        df.to_csv(path, mode="w" if start == 0 else "a", header=start == 0, index=False)
+
+
+def build(db_path, rows, workers=1, seed=0):
+    # Synthetic database of rows occurrences at db_path, through write_to_db.py
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, "synthetic.csv")
+        logging.warning(f"Generating {rows} occurrences...")
+        synthetic_csv(csv_path, rows, seed)
+        logging.warning(f"Importing into {db_path}...")
+        chunksize = STREAM_ROWS if rows > STREAM_ROWS else None
+        write_to_db.main(csv_path, db_path, chunksize, workers=workers)
+
+
+def samples(db_path):
+    """
+    Ids used in the urls of the routes, the most frequent ones so the detail
+    pages have occurrences to show.
+    """
+    con = sqlite3.connect(db_path)
+    one = lambda sql: con.execute(sql).fetchone()[0]
+    try:
+        lat, lon = con.execute(
+            "SELECT AVG(lat), AVG(lon) FROM locais WHERE lat IS NOT NULL"
+        ).fetchone()
+        return {
+            "occId": one("SELECT MAX(occId) FROM ocorrencias"),
+            "areaId": one(
+                "SELECT areaId FROM ocorrencias "
+                "GROUP BY 1 ORDER BY COUNT(*) DESC LIMIT 1"
+            ),
+            "crimeId": one(
+                "SELECT crimeId FROM occ_crime "
+                "GROUP BY 1 ORDER BY COUNT(*) DESC LIMIT 1"
+            ),
+            "armaId": one(
+                "SELECT armaId FROM ocorrencias WHERE armaId IS NOT NULL "
+                "GROUP BY 1 ORDER BY COUNT(*) DESC LIMIT 1"
+            ),
+            "localId": one(
+                "SELECT localId FROM ocorrencias "
+                "GROUP BY 1 ORDER BY COUNT(*) DESC LIMIT 1"
+            ),
+            "vitimaId": one("SELECT MIN(vitimaId) FROM vitimas"),
+            "sexoId": one("SELECT MIN(sexoId) FROM sexos"),
+            "lat": round(lat - 0.01, 4),
+            "lon": round(lon - 0.01, 4),
+            "lat_1": round(lat + 0.01, 4),
+            "lon_1": round(lon + 0.01, 4),
+        }
+    finally:
+        con.close()
+
+
+def urls(app, ids):
+    # rule -> url for every route of app, None for the ones it cannot fill
+    found = {}
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint == "static" or "GET" not in rule.methods:
+            continue
+        if rule.rule in URLS:
+            found[rule.rule] = URLS[rule.rule].format(**ids)
+        else:
+            found[rule.rule] = None if rule.arguments else rule.rule
+    return found
+
+
+def _percentiles(latencies):
+    p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+    return round(p50, 3), round(p95, 3), round(p99, 3)
+
+
+def _get(client, url):
+    start = time.perf_counter()
+    response = client.get(url)
+    response.get_data()
+    elapsed = time.perf_counter() - start
+    if response.status_code != 200:
+        raise RuntimeError(f"{url} answered {response.status_code}")
+    return elapsed
+
+
+def measure(app, url, requests=50, concurrency=8):
+    """
+    Latency percentiles in ms of requests sequential GETs of url, the same
+    under concurrency threads, the requests per second those threads
+    reached and the peak Python memory of one request in KiB.
+    """
+    client = app.test_client()
+    _get(client, url)
+
+    sequential = [_get(client, url) for _ in range(requests)]
+
+    tracemalloc.start()
+    _get(client, url)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    def worker(n):
+        c = app.test_client()
+        return [_get(c, url) for _ in range(n)]
+
+    per_thread = max(1, requests // concurrency)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        loaded = [t for ts in pool.map(worker, [per_thread] * concurrency) for t in ts]
+    wall = time.perf_counter() - start
+
+    p50, p95, p99 = _percentiles(sequential)
+    load_p50, load_p95, load_p99 = _percentiles(loaded)
+    return {
+        "p50_ms": p50,
+        "p95_ms": p95,
+        "p99_ms": p99,
+        "load_p50_ms": load_p50,
+        "load_p95_ms": load_p95,
+        "load_p99_ms": load_p99,
+        "requests_per_second": round(len(loaded) / wall, 1),
+        "peak_kib": round(peak / 1024, 1),
+    }
+
+
+def run(db_path, requests=50, concurrency=8, cached=False):
+    """
+    Benchmarks every route of app.py against the database at db_path.
+    Unless cached, the response cache is turned off so the views run every
+    time.
+    """
+    import app
+    import cache
+    import db
+
+    if not cached:
+        cache.MAX_ENTRIES = 0
+    db.connect(db_path, pool_size=max(db.POOL_SIZE, concurrency))
+    targets = urls(app.APP, samples(db_path))
+    for rule, url in targets.items():
+        if url is None:
+            logging.warning(f"Skipping {rule}, add its url to URLS")
+    # Slow queries are expected on large data, keep them out of the output
+    logging.disable(logging.WARNING)
+    try:
+        results = []
+        for rule, url in targets.items():
+            if url is not None:
+                result = {"route": rule, "url": url}
+                result.update(measure(app.APP, url, requests, concurrency))
+                results.append(result)
+    finally:
+        logging.disable(logging.NOTSET)
+        db.close()
+    return results
+
+
+def compare(results, baseline, threshold=1.2):
+    # Routes whose p95 grew by more than threshold since the baseline
+    before = {r["route"]: r for r in baseline["routes"]}
+    return [
+        (r["route"], before[r["route"]]["p95_ms"], r["p95_ms"])
+        for r in results
+        if r["route"] in before
+        and r["p95_ms"] > before[r["route"]]["p95_ms"] * threshold
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark every route of app.py")
+    parser.add_argument(
+        "--db", help="benchmark this database instead of a synthetic one"
+    )
+    parser.add_argument(
+        "--rows", type=int, default=100_000, help="occurrences of the synthetic data"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--workers", type=int, default=1, help="processes importing the synthetic csv"
+    )
+    parser.add_argument("--requests", type=int, default=50, help="requests per route")
+    parser.add_argument("--concurrency", type=int, default=8, help="threads under load")
+    parser.add_argument(
+        "--cached", action="store_true", help="keep the response cache on"
+    )
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument(
+        "--baseline", help="results of an earlier run to report regressions against"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = args.db
+        if db_path is None:
+            db_path = os.path.join(tmp, "bench.db")
+            build(db_path, args.rows, args.workers, args.seed)
+        results = run(db_path, args.requests, args.concurrency, args.cached)
+        rows = sqlite3.connect(db_path).execute("SELECT COUNT() FROM ocorrencias")
+        rows = rows.fetchone()[0]
+
+    print(
+        "%-36s %9s %9s %9s %9s %9s %10s"
+        % ("route", "p50 ms", "p95 ms", "p99 ms", "load p95", "req/s", "peak KiB")
+    )
+    for r in results:
+        print(
+            "%-36s %9.2f %9.2f %9.2f %9.2f %9.1f %10.1f"
+            % (
+                r["route"],
+                r["p50_ms"],
+                r["p95_ms"],
+                r["p99_ms"],
+                r["load_p95_ms"],
+                r["requests_per_second"],
+                r["peak_kib"],
+            )
+        )
+    # ru_maxrss is in KiB on Linux
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("max rss %.1f MiB" % (max_rss / 1024))
+
+    report = {
+        "rows": rows,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "cached": args.cached,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "max_rss_kib": max_rss,
+        "time": time.time(),
+        "routes": results,
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = compare(results, json.load(f))
+        for route, before, after in slower:
+            print("slower: %-36s p95 %.2f -> %.2f ms" % (route, before, after))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,111 @@
+from collections import OrderedDict
+import threading
+import zlib
+
+from flask import Response, current_app, g, request
+import db
+
+
+# Bounds of the response cache, the least recently used pages go first
+MAX_ENTRIES = 1024
+MAX_BYTES = 64 * 1024 * 1024
+
+# full path -> (status, headers, body), all for generation _state["generation"]
+_cache = OrderedDict()
+_state = {"generation": None, "bytes": 0}
+_lock = threading.Lock()
+
+
+def exempt(view):
+    # Decorator for views whose response must never be cached
+    view.no_cache = True
+    return view
+
+
+def _cacheable():
+    if request.method not in ("GET", "HEAD"):
+        return False
+    view = current_app.view_functions.get(request.endpoint)
+    return view is not None and not getattr(view, "no_cache", False)
+
+
+def _etag(key):
+    # Pages only change when a new database is imported
+    return "{}-{:08x}".format(db.DB["generation"], zlib.crc32(key.encode()))
+
+
+def clear():
+    with _lock:
+        _cache.clear()
+        _state["bytes"] = 0
+
+
+def _before():
+    if not _cacheable():
+        return None
+    db.reopen_if_replaced()
+    if _state["generation"] != db.DB["generation"]:
+        clear()
+        _state["generation"] = db.DB["generation"]
+
+    key = request.full_path
+    with _lock:
+        entry = _cache.get(key)
+        if entry is not None:
+            _cache.move_to_end(key)
+
+    if request.if_none_match.contains(_etag(key)) or (
+        entry is not None
+        and request.if_modified_since is not None
+        and request.if_modified_since.timestamp() >= int(db.DB["built_at"])
+    ):
+        response = Response(status=304)
+        response.set_etag(_etag(key))
+        return response
+
+    if entry is not None:
+        g.cache_hit = True
+        status, headers, body = entry
+        return Response(body, status=status, headers=headers)
+    return None
+
+
+def _after(response):
+    if (
+        response.status_code != 200
+        or response.is_streamed
+        or response.direct_passthrough
+        or g.get("cache_hit")
+        or not _cacheable()
+    ):
+        return response
+
+    key = request.full_path
+    response.set_etag(_etag(key))
+    response.last_modified = int(db.DB["built_at"])
+    response.cache_control.no_cache = True
+
+    body = response.get_data()
+    if len(body) > MAX_BYTES // 16 or _state["generation"] != db.DB["generation"]:
+        return response
+    headers = [(k, v) for k, v in response.headers if k.lower() != "set-cookie"]
+    with _lock:
+        old = _cache.pop(key, None)
+        if old is not None:
+            _state["bytes"] -= len(old[2])
+        _cache[key] = (response.status_code, headers, body)
+        _state["bytes"] += len(body)
+        while len(_cache) > MAX_ENTRIES or _state["bytes"] > MAX_BYTES:
+            _, (_, _, evicted) = _cache.popitem(last=False)
+            _state["bytes"] -= len(evicted)
+    return response
+
+
+def init_app(app):
+    """
+    Caches whole responses in memory, keyed by path and query string, until
+    write_to_db.py stamps a new database generation. Responses get ETag and
+    Last-Modified headers and conditional requests are answered with 304.
+    """
+    app.before_request(_before)
+    app.after_request(_after)
@@ -0,0 +1,434 @@
+from datetime import datetime
+import json
+import logging
+import os
+import shutil
+import threading
+from sqlite3 import Connection
+
+import numpy as np
+
+import db
+
+
+# Columnar snapshot of the occurrences written next to the database by
+# write_to_db.py, one .npy file per column, memory mapped read only so every
+# worker process shares the same pages. Rows are sorted by (date_occ, occId),
+# missing keys are stored as -1. column -> dtype
+COLUMNS = {
+    "occId": "int64",
+    "date_occ": "datetime64[s]",
+    "areaId": "int16",
+    "localId": "int16",
+    "armaId": "int16",
+    "vitimaId": "int32",
+    "idade": "int16",
+    "sexoId": "int8",
+    "descendenciaId": "int8",
+}
+
+# Crimes of the occurrences, one entry per (occurrence, crime) sorted by
+# crime_row, the occurrence's row in COLUMNS. The crimes of row r are the
+# entries crime_offsets[r] to crime_offsets[r + 1].
+EDGES = {"crime_row": "int32", "crimeId": "int16"}
+
+# Keys indexed per code: <key>.rows.npy holds the rows having each code,
+# ascending, code after code, and <key>.offsets.npy where each code starts.
+# Rows missing the key are left out.
+INDEXED = [
+    "areaId",
+    "localId",
+    "armaId",
+    "crimeId",
+    "idade",
+    "sexoId",
+    "descendenciaId",
+]
+
+# Labels of the codes, dictionary -> query returning (code, label)
+LABELS = {
+    "areaId": "SELECT areaId, nome FROM areas",
+    "localId": "SELECT localId, desc_local FROM locais",
+    "armaId": "SELECT armaId, desc_arma FROM armas",
+    "crimeId": "SELECT crimeId, desc_crime FROM crimes",
+    "sexoId": "SELECT sexoId, sexo FROM sexos",
+    "descendenciaId": "SELECT descendenciaId, descendencia FROM descendencias",
+}
+
+# Rows read from sqlite at a time while writing a snapshot
+CHUNK_ROWS = 100_000
+
+_snapshot = {"generation": None, "snapshot": None}
+_lock = threading.Lock()
+
+
+def path(db_path, generation):
+    # One directory per generation, so a database always finds its own
+    return os.path.join(db_path + ".columns", str(generation))
+
+
+def _fill(con, sql, n, arrays):
+    # Fills the preallocated arrays with the columns of sql, CHUNK_ROWS rows
+    # at a time
+    import pandas as pd
+
+    offset = 0
+    for chunk in pd.read_sql_query(sql, con, chunksize=CHUNK_ROWS):
+        end = offset + len(chunk)
+        for name, array in arrays.items():
+            if array.dtype.kind == "M":
+                array[offset:end] = pd.to_datetime(chunk[name]).values
+            else:
+                array[offset:end] = chunk[name].fillna(-1).to_numpy()
+        offset = end
+    if offset != n:
+        raise RuntimeError("Expected {} rows, read {}".format(n, offset))
+
+
+def _index(directory, key, values, edges):
+    # Writes <key>.rows.npy and <key>.offsets.npy for the codes in values
+    order = np.argsort(values, kind="stable")
+    present = order[np.asarray(values)[order] >= 0]
+    rows = edges["crime_row"][present] if key == "crimeId" else present
+    counts = np.bincount(np.asarray(values)[present].astype(np.int64))
+    np.save(os.path.join(directory, key + ".rows.npy"), rows.astype("int32"))
+    np.save(
+        os.path.join(directory, key + ".offsets.npy"),
+        np.concatenate([[0], np.cumsum(counts)]).astype("int64"),
+    )
+
+
+def write(con: Connection, db_path: str, generation: int):
+    """
+    Writes the snapshot of the database behind con next to db_path, to be
+    put in place with publish(). Columns are written straight to their
+    files, only CHUNK_ROWS rows are held in memory at a time.
+    """
+    tmp = path(db_path, generation) + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    def create(name, dtype, n):
+        return np.lib.format.open_memmap(
+            os.path.join(tmp, name + ".npy"), mode="w+", dtype=dtype, shape=(n,)
+        )
+
+    n = con.execute("SELECT COUNT(*) FROM ocorrencias").fetchone()[0]
+    columns = {name: create(name, dtype, n) for name, dtype in COLUMNS.items()}
+    _fill(
+        con,
+        """
+        SELECT o.occId, o.date_occ, o.areaId, o.localId, o.armaId, o.vitimaId,
+          v.idade, v.sexoId, v.descendenciaId
+        FROM ocorrencias o
+          LEFT JOIN vitimas v ON v.vitimaId = o.vitimaId
+        ORDER BY o.date_occ, o.occId
+        """,
+        n,
+        columns,
+    )
+
+    m = con.execute("SELECT COUNT(*) FROM occ_crime").fetchone()[0]
+    edges = {name: create(name, dtype, m) for name, dtype in EDGES.items()}
+    # occIds of the edges go in crime_row first and are mapped to rows below
+    _fill(
+        con,
+        "SELECT occId AS crime_row, crimeId FROM occ_crime ORDER BY occId, crimeId",
+        m,
+        {"crime_row": create("occId.edges", "int64", m), "crimeId": edges["crimeId"]},
+    )
+    occIds = np.load(os.path.join(tmp, "occId.edges.npy"), mmap_mode="r")
+    by_occId = np.argsort(columns["occId"])
+    for start in range(0, m, CHUNK_ROWS):
+        chunk = occIds[start : start + CHUNK_ROWS]
+        found = np.searchsorted(columns["occId"], chunk, sorter=by_occId)
+        edges["crime_row"][start : start + CHUNK_ROWS] = by_occId[found]
+    del occIds
+    os.remove(os.path.join(tmp, "occId.edges.npy"))
+
+    # Edges grouped by row, then the per code indexes
+    order = np.lexsort((edges["crimeId"], edges["crime_row"]))
+    for array in edges.values():
+        array[:] = array[order]
+    del order
+    offsets = create("crime_offsets", "int64", n + 1)
+    offsets[:] = np.searchsorted(edges["crime_row"], np.arange(n + 1))
+    for key in INDEXED:
+        _index(tmp, key, edges["crimeId"] if key == "crimeId" else columns[key], edges)
+    for array in [offsets] + list(columns.values()) + list(edges.values()):
+        array.flush()
+
+    labels = {
+        name: {str(code): label for code, label in con.execute(sql)}
+        for name, sql in LABELS.items()
+    }
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump({"generation": generation, "rows": n, "labels": labels}, f)
+    return n
+
+
+def publish(db_path: str, generation: int):
+    """
+    Puts the snapshot written with write() in place, before the database of
+    that generation is, and removes the ones older than the current
+    database's, which no process opens anymore.
+    """
+    final = path(db_path, generation)
+    shutil.rmtree(final, ignore_errors=True)
+    os.replace(final + ".tmp", final)
+    parent = os.path.dirname(final)
+    for name in os.listdir(parent):
+        if name.isdigit() and int(name) < generation - 1:
+            shutil.rmtree(os.path.join(parent, name), ignore_errors=True)
+
+
+def _load(directory):
+    with open(os.path.join(directory, "meta.json")) as f:
+        meta = json.load(f)
+
+    def load(name):
+        return np.load(os.path.join(directory, name + ".npy"), mmap_mode="r")
+
+    columns = {name: load(name) for name in list(COLUMNS) + list(EDGES)}
+    columns["crime_offsets"] = load("crime_offsets")
+    index = {key: (load(key + ".rows"), load(key + ".offsets")) for key in INDEXED}
+    labels = {
+        name: {int(code): label for code, label in codes.items()}
+        for name, codes in meta["labels"].items()
+    }
+    return meta["generation"], columns, index, labels
+
+
+def get():
+    """
+    The snapshot of the open database as {"columns", "index", "totals",
+    "labels", "rows"}, or None when its generation has none.
+    """
+    db.reopen_if_replaced()
+    if _snapshot["generation"] == db.DB["generation"]:
+        return _snapshot["snapshot"]
+    with _lock:
+        if _snapshot["generation"] != db.DB["generation"]:
+            snapshot = None
+            try:
+                # Published before the database, so it is there for any
+                # generation the open database can have
+                _, columns, index, labels = _load(
+                    path(db.DB["path"], db.DB["generation"])
+                )
+            except (OSError, ValueError) as e:
+                logging.warning("No columnar snapshot: {}".format(e))
+            else:
+                snapshot = {
+                    "columns": columns,
+                    "index": index,
+                    # Occurrences per code of every indexed key
+                    "totals": {
+                        key: np.diff(offsets) for key, (_, offsets) in index.items()
+                    },
+                    "labels": labels,
+                    "rows": len(columns["occId"]),
+                }
+            _snapshot.update(snapshot=snapshot, generation=db.DB["generation"])
+    return _snapshot["snapshot"]
+
+
+def _filters(snapshot, since=None, until=None, idade=None, **keys):
+    # The filters in use: "date_occ" as a (start, end) slice of the rows,
+    # which are sorted by date, and the indexed keys as a list of codes
+    found = {}
+    if since is not None or until is not None:
+        dates = snapshot["columns"]["date_occ"]
+        start = 0 if since is None else np.searchsorted(dates, np.datetime64(since))
+        end = (
+            snapshot["rows"]
+            if until is None
+            else np.searchsorted(dates, np.datetime64(until))
+        )
+        found["date_occ"] = (int(start), int(end))
+    if idade is not None and idade != (None, None):
+        low, high = idade
+        last = len(snapshot["totals"]["idade"]) - 1
+        high = last if high is None else min(high, last)
+        found["idade"] = list(range(max(low or 0, 0), high + 1))
+    for key, codes in keys.items():
+        if codes:
+            found[key] = list(codes)
+    return found
+
+
+def _codes(snapshot, key, codes):
+    # Codes of a key that occur at all
+    return [c for c in codes if 0 <= c < len(snapshot["totals"][key])]
+
+
+def _size(snapshot, name, value):
+    # Rows a filter matches, without reading them
+    if name == "date_occ":
+        return value[1] - value[0]
+    totals = snapshot["totals"][name]
+    return sum(int(totals[c]) for c in _codes(snapshot, name, value))
+
+
+def _rows(snapshot, name, value):
+    # Sorted rows matching a filter
+    if name == "date_occ":
+        return np.arange(*value)
+    rows, offsets = snapshot["index"][name]
+    parts = [rows[offsets[c] : offsets[c + 1]] for c in _codes(snapshot, name, value)]
+    if not parts:
+        return np.empty(0, dtype=np.int64)
+    if len(parts) == 1:
+        return np.asarray(parts[0])
+    # Only an occurrence with several crimes can be in more than one part
+    if name == "crimeId":
+        return np.unique(np.concatenate(parts))
+    return np.sort(np.concatenate(parts))
+
+
+def _edges(snapshot, rows):
+    # Positions in EDGES of the crimes of rows, and how many each row has
+    offsets = snapshot["columns"]["crime_offsets"]
+    starts = offsets[rows]
+    lengths = offsets[rows + 1] - starts
+    shift = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return shift + np.arange(len(shift)), lengths
+
+
+def _allowed(snapshot, name, value):
+    # Lookup table of the accepted codes, its last entry stays False for the
+    # -1 of missing keys
+    allowed = np.zeros(len(snapshot["totals"][name]) + 1, dtype=bool)
+    allowed[_codes(snapshot, name, value)] = True
+    return allowed
+
+
+def _keep(snapshot, name, value, rows):
+    # Which of rows pass a filter
+    if name == "date_occ":
+        return (rows >= value[0]) & (rows < value[1])
+    allowed = _allowed(snapshot, name, value)
+    if name == "crimeId":
+        edges, lengths = _edges(snapshot, rows)
+        owner = np.repeat(np.arange(len(rows)), lengths)
+        keep = np.zeros(len(rows), dtype=bool)
+        keep[owner[allowed[snapshot["columns"]["crimeId"][edges]]]] = True
+        return keep
+    return allowed[snapshot["columns"][name][rows]]
+
+
+def _select(snapshot, found, skip=None, memo=None):
+    """
+    Rows matching every filter of found but skip: the rows of the most
+    selective filter narrowed down by the others. memo keeps the rows and
+    filter results between calls over the same filters.
+    """
+    names = sorted(
+        (n for n in found if n != skip), key=lambda n: _size(snapshot, n, found[n])
+    )
+    if not names:
+        return None
+    memo = {} if memo is None else memo
+    base = names[0]
+    if base not in memo:
+        memo[base] = {None: _rows(snapshot, base, found[base])}
+    rows = memo[base][None]
+    keep = np.ones(len(rows), dtype=bool)
+    for name in names[1:]:
+        if name not in memo[base]:
+            memo[base][name] = _keep(snapshot, name, found[name], rows)
+        keep &= memo[base][name]
+    return rows[keep]
+
+
+def select(snapshot, **filters):
+    """
+    Sorted rows matching every filter, or None when there are none so every
+    row matches: since <= date_occ < until ("YYYY-MM-DD"), idade as (min,
+    max) with either end None and the other keys of INDEXED as a list of
+    accepted codes. Filters that are None or an empty list are left out.
+    Only the rows of the most selective filter are ever read.
+    """
+    return _select(snapshot, _filters(snapshot, **filters))
+
+
+def total(snapshot, rows):
+    return snapshot["rows"] if rows is None else len(rows)
+
+
+def facets(snapshot, by, **filters):
+    """
+    count() for every key of by, each over the rows matching every filter
+    but the one on the key itself, so the other choices of a key are
+    counted as well.
+    """
+    found = _filters(snapshot, **filters)
+    memo = {}
+    return {
+        key: count(snapshot, key, _select(snapshot, found, key, memo)) for key in by
+    }
+
+
+def _position(snapshot, key, side):
+    # Row of a (date_occ, occId) key in the sorted rows
+    date, occId = key
+    dates = snapshot["columns"]["date_occ"]
+    date = np.datetime64(datetime.fromisoformat(date), "s")
+    start = np.searchsorted(dates, date, "left")
+    end = np.searchsorted(dates, date, "right")
+    return start + np.searchsorted(
+        snapshot["columns"]["occId"][start:end], occId, side
+    )
+
+
+def page(snapshot, rows, limit, after=None, before=None):
+    """
+    occIds of the rows of select() for a page of the keyset pagination
+    newest first: up to limit rows older than the (date_occ, occId) key
+    after, or up to limit rows newer than before, oldest first like the
+    "before" queries of queries.py.
+    """
+    n = snapshot["rows"]
+    if before is not None:
+        start = _position(snapshot, before, "right")
+        if rows is None:
+            picked = np.arange(start, min(start + limit, n))
+        else:
+            picked = rows[np.searchsorted(rows, start) :][:limit]
+    else:
+        end = n if after is None else _position(snapshot, after, "left")
+        if rows is None:
+            picked = np.arange(end - 1, max(end - limit, 0) - 1, -1)
+        else:
+            picked = rows[: np.searchsorted(rows, end)][::-1][:limit]
+    return snapshot["columns"]["occId"][picked].tolist()
+
+
+def count(snapshot, by, rows=None, top=None):
+    """
+    Occurrences per code of an indexed key among rows of select(), all of
+    them for None, as [(code, label, count)] sorted by count. Missing keys
+    are left out.
+    """
+    columns = snapshot["columns"]
+    if rows is None:
+        counts = snapshot["totals"][by]
+    else:
+        # A date range alone selects a run of rows, read as a slice
+        run = len(rows) and rows[-1] - rows[0] + 1 == len(rows)
+        if by == "crimeId" and run:
+            offsets = columns["crime_offsets"]
+            keys = columns["crimeId"][offsets[rows[0]] : offsets[rows[-1] + 1]]
+        elif by == "crimeId":
+            keys = columns["crimeId"][_edges(snapshot, rows)[0]]
+        elif run:
+            keys = columns[by][rows[0] : rows[-1] + 1]
+        else:
+            keys = columns[by][rows]
+        counts = np.bincount(keys[keys >= 0].astype(np.int64))
+    codes = np.flatnonzero(counts)
+    order = codes[np.argsort(-counts[codes], kind="stable")]
+    if top is not None:
+        order = order[:top]
+    labels = snapshot["labels"].get(by, {})
+    return [(int(c), labels.get(int(c)), int(counts[c])) for c in order]
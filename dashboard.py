@@ -0,0 +1,61 @@
+import logging
+import threading
+import time
+
+import db
+
+
+# Seconds the dashboard counts are served from memory before being queried again
+TTL = 300
+
+_cache = {"stats": None, "at": 0.0, "generation": None}
+_lock = threading.Lock()
+
+
+def refresh():
+    with db.connection() as c:
+        stats = dict(db.run_on(c, "dashboard").fetchone())
+        generation = c.generation
+    _cache.update(stats=stats, at=time.monotonic(), generation=generation)
+    logging.info("Dashboard stats refreshed: {}".format(stats))
+    return stats
+
+
+def invalidate():
+    _cache["stats"] = None
+
+
+def get():
+    # A new data.db (see write_to_db.py) invalidates the cached counts
+    db.reopen_if_replaced()
+    stats = _cache["stats"]
+    if (
+        stats is not None
+        and _cache["generation"] == db.DB["generation"]
+        and time.monotonic() - _cache["at"] < TTL
+    ):
+        return stats
+
+    # Only one thread queries, the others keep serving the old counts
+    if not _lock.acquire(blocking=stats is None):
+        return stats
+    try:
+        return refresh()
+    finally:
+        _lock.release()
+
+
+def start_refresher(interval=TTL / 2):
+    # Refreshes the counts in the background so requests don't wait for them
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                with _lock:
+                    refresh()
+            except Exception:
+                logging.exception("Refreshing dashboard stats failed")
+
+    thread = threading.Thread(target=run, name="stats-refresher", daemon=True)
+    thread.start()
+    return thread
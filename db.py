@@ -1,30 +1,344 @@
+from contextlib import contextmanager
 import logging
+import os
+import queue
 import sqlite3
-import re
+import threading
+import time
+
+from flask import g, has_app_context
+import metrics
+import queries
+import schema
 
 
 global DB
 DB = dict()
 
+# Maximum number of connections checked out at the same time
+POOL_SIZE = 8
+# Seconds to wait for a free connection before giving up
+POOL_TIMEOUT = 30
 
-def connect():
-    global DB
-    c = sqlite3.connect("data.db", check_same_thread=False)
+# Compiled statements kept per connection, enough for every named query of
+# queries.py plus the ad hoc ones run with execute()
+CACHED_STATEMENTS = 256
+
+# Bytes of the database file every connection memory maps, pages read through
+# the map are shared by all processes in the OS page cache
+MMAP_SIZE = 1024 * 1024 * 1024
+# Private page cache of every connection, in KiB
+CACHE_KIB = 16 * 1024
+
+# Block size warm() reads the database file with
+WARM_BLOCK = 1024 * 1024
+
+# Connections used outside of a Flask app context (scripts, shell)
+_local = threading.local()
+
+
+class Connection(sqlite3.Connection):
+    # Inode of the database file the connection was opened on
+    ino = None
+    # Generation stamped in that file, inodes get reused by later imports
+    generation = None
+    # Cursors whose statement is not reported to metrics yet
+    pending = None
+
+
+class Cursor(sqlite3.Cursor):
+    # Times a statement from execute() until its rows are fetched to the end,
+    # the cursor is closed or its connection goes back to the pool, then
+    # reports it to metrics. Never from __del__: a finalizer can run while
+    # its thread already holds metrics._lock.
+    sql = None
+    args = None
+    rows = 0
+    elapsed = 0.0
+
+    def _timed(self, fetch, *a):
+        start = time.perf_counter()
+        try:
+            return fetch(*a)
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+    def execute(self, sql, args=()):
+        self.sql, self.args = sql, args
+        self.connection.pending.add(self)
+        return self._timed(super().execute, sql, args)
+
+    def fetchone(self):
+        row = self._timed(super().fetchone)
+        if row is None:
+            self._done()
+        else:
+            self.rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self._timed(super().fetchmany, size or self.arraysize)
+        self.rows += len(rows)
+        if not rows:
+            self._done()
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(super().fetchall)
+        self.rows += len(rows)
+        self._done()
+        return rows
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+    def _done(self):
+        if self.sql is not None:
+            self.connection.pending.discard(self)
+            metrics.record_query(self.sql, self.args, self.elapsed * 1000, self.rows)
+            self.sql = None
+
+    def close(self):
+        self._done()
+        super().close()
+
+
+def _open():
+    if DB["readonly"]:
+        # immutable skips locking and change detection, safe because
+        # write_to_db.py never changes a file in place but renames a new one
+        # over it, which reopen_if_replaced() notices
+        c = sqlite3.connect(
+            "file:{}?mode=ro{}".format(
+                DB["path"], "&immutable=1" if DB["immutable"] else ""
+            ),
+            uri=True,
+            check_same_thread=False,
+            factory=Connection,
+            cached_statements=CACHED_STATEMENTS,
+        )
+        c.execute("PRAGMA query_only = 1")
+    else:
+        c = sqlite3.connect(
+            DB["path"],
+            check_same_thread=False,
+            factory=Connection,
+            cached_statements=CACHED_STATEMENTS,
+        )
+    c.execute("PRAGMA cache_size = -{:d}".format(DB["cache_kib"]))
+    c.execute("PRAGMA mmap_size = {:d}".format(DB["mmap_size"]))
     c.row_factory = sqlite3.Row
-    DB["conn"] = c
-    DB["cursor"] = c.cursor()
-    logging.info("Connected to database")
+    c.ino = DB.get("ino")
+    c.generation = DB.get("generation")
+    c.pending = set()
+    return c
 
 
-def execute(sql, args=None):
+def _setup():
+    # Runs whenever a new database file is opened
+    global DB
+    st = os.stat(DB["path"])
+    # WAL lets readers run concurrently. The mode is stored in the file, so
+    # setting it once here is enough for every pooled connection.
+    c = _open()
+    if DB["readonly"]:
+        mode = c.execute("PRAGMA journal_mode").fetchone()[0]
+    else:
+        mode = c.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+    if schema.version(c) < schema.VERSION:
+        logging.warning(
+            "Database schema is older than version {}, run write_to_db.py again".format(
+                schema.VERSION
+            )
+        )
+    # Generation stamped by write_to_db.py, files from before it fall back to
+    # the modification time
+    generation, built_at = schema.generation(c)
+    DB["generation"] = c.generation = generation or int(st.st_mtime)
+    DB["built_at"] = built_at or st.st_mtime
+    DB["ino"] = c.ino = st.st_ino
+    DB["idle"].put(c)
+    logging.info(
+        "Opened {} (journal_mode={}, generation={})".format(
+            DB["path"], mode, DB["generation"]
+        )
+    )
+
+
+def _close_idle():
+    global DB
+    while True:
+        try:
+            DB["idle"].get_nowait().close()
+        except queue.Empty:
+            break
+
+
+def reopen_if_replaced():
+    # write_to_db.py builds a new file and renames it over the old one, open
+    # connections keep reading the old file until they are replaced
+    global DB
+    try:
+        ino = os.stat(DB["path"]).st_ino
+    except FileNotFoundError:
+        return
+    if ino == DB["ino"]:
+        return
+    with DB["lock"]:
+        if ino != DB["ino"]:
+            logging.info("{} was replaced, reopening connections".format(DB["path"]))
+            _close_idle()
+            _setup()
+
+
+def connect(
+    path="data.db",
+    pool_size=POOL_SIZE,
+    readonly=False,
+    immutable=False,
+    cache_kib=CACHE_KIB,
+    mmap_size=MMAP_SIZE,
+):
+    # immutable implies readonly
     global DB
-    sql = re.sub("\s+", " ", sql)
-    logging.info("SQL: {} Args: {}".format(sql, args))
-    return (
-        DB["cursor"].execute(sql, args) if args != None else DB["cursor"].execute(sql)
+    DB["path"] = path
+    DB["readonly"] = readonly or immutable
+    DB["immutable"] = immutable
+    DB["cache_kib"] = cache_kib
+    DB["mmap_size"] = mmap_size
+    DB["idle"] = queue.LifoQueue()
+    DB["slots"] = threading.BoundedSemaphore(pool_size)
+    DB["lock"] = threading.Lock()
+    _setup()
+    logging.info(
+        "Connected to database (pool_size={}, readonly={}, immutable={})".format(
+            pool_size, DB["readonly"], immutable
+        )
+    )
+
+
+def warm(path="data.db", limit=MMAP_SIZE):
+    """
+    Reads the database file once so its pages sit in the OS page cache, where
+    every process mapping the file finds them. Of a file larger than limit
+    bytes only the last limit are read: write_to_db.py builds the indexes,
+    summary tables and the other derived structures after the tables, so
+    they end up at the end of the file. Returns the bytes read.
+    """
+    start = time.perf_counter()
+    size = os.path.getsize(path)
+    offset = max(0, size - limit)
+    read = 0
+    with open(path, "rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), offset, 0, os.POSIX_FADV_WILLNEED)
+        f.seek(offset)
+        while True:
+            block = f.read(WARM_BLOCK)
+            if not block:
+                break
+            read += len(block)
+    logging.info(
+        "Warmed {} MiB of {} in {:.2f}s".format(
+            read // (1024 * 1024), path, time.perf_counter() - start
+        )
     )
+    return read
+
+
+def checkout():
+    global DB
+    reopen_if_replaced()
+    if not DB["slots"].acquire(timeout=POOL_TIMEOUT):
+        raise RuntimeError(
+            "No database connection available after {}s".format(POOL_TIMEOUT)
+        )
+    try:
+        c = DB["idle"].get_nowait()
+        if c.ino == DB["ino"]:
+            return c
+        c.close()
+    except queue.Empty:
+        pass
+    try:
+        return _open()
+    except Exception:
+        DB["slots"].release()
+        raise
+
+
+def checkin(c):
+    global DB
+    # Statements read only in part, eg. a single fetchone()
+    for cursor in list(c.pending):
+        cursor._done()
+    if c.ino != DB["ino"]:
+        c.close()
+    else:
+        if c.in_transaction:
+            c.rollback()
+        DB["idle"].put(c)
+    DB["slots"].release()
+
+
+@contextmanager
+def connection():
+    # Explicit checkout, for code running outside of a request
+    c = checkout()
+    try:
+        yield c
+    finally:
+        checkin(c)
+
+
+def _holder():
+    return g if has_app_context() else _local
+
+
+def _conn():
+    holder = _holder()
+    c = getattr(holder, "db_conn", None)
+    if c is None:
+        c = holder.db_conn = checkout()
+    return c
+
+
+def release(exc=None):
+    # Registered as an app context teardown, so every request gives its
+    # connection back to the pool when it finishes.
+    holder = _holder()
+    c = getattr(holder, "db_conn", None)
+    if c is not None:
+        holder.db_conn = None
+        checkin(c)
+
+
+def init_app(app):
+    app.teardown_appcontext(release)
+
+
+def execute_on(c, sql, args=None):
+    logging.debug("SQL: %s Args: %s", sql, args)
+    return c.cursor(Cursor).execute(sql, args if args is not None else ())
+
+
+def execute(sql, args=None):
+    # Ad hoc statements, the app runs the named ones of queries.py with run()
+    return execute_on(_conn(), sql, args)
+
+
+def run_on(c, name, args=None):
+    return execute_on(c, queries.QUERIES[name], args)
+
+
+def run(name, args=None):
+    return run_on(_conn(), name, args)
 
 
 def close():
     global DB
-    DB["conn"].close()
+    release()
+    _close_idle()
@@ -0,0 +1,73 @@
+import logging
+import re
+from sqlite3 import Connection
+
+import db
+import queries
+
+
+# FTS5 indexes behind the search routes, built by write_to_db.py after every
+# import. name -> (table, key column, indexed columns)
+INDEXES = {
+    "areas_fts": ("areas", "areaId", ["nome"]),
+    "crimes_fts": ("crimes", "crimeId", ["desc_crime"]),
+    "armas_fts": ("armas", "armaId", ["desc_arma"]),
+    "locais_fts": ("locais", "localId", ["desc_local", "morada"]),
+}
+
+# One search statement per index, run by search()
+for name, (table, key, _) in INDEXES.items():
+    queries.register(
+        "search:" + name,
+        f"""
+        SELECT {table}.*
+        FROM {name} JOIN {table} ON {table}.{key} = {name}.rowid
+        WHERE {name} MATCH ?
+        ORDER BY rank
+        LIMIT ?
+        """,
+    )
+
+# Maximum number of results returned by a search
+LIMIT = 100
+
+
+def build(con: Connection):
+    for name, (table, key, columns) in INDEXES.items():
+        logging.info(f"Creating {name}...")
+        con.execute(f"DROP TABLE IF EXISTS {name}")
+        con.execute(
+            f"""
+            CREATE VIRTUAL TABLE {name} USING fts5(
+                {", ".join(columns)},
+                content='{table}',
+                content_rowid='{key}',
+                prefix='2 3'
+            )
+            """
+        )
+        con.execute(f"INSERT INTO {name}({name}) VALUES ('rebuild')")
+
+
+def query(expr, column=None):
+    """
+    Turns user input into an FTS5 query where every word must match the
+    start of a token, eg. "5th st" -> '"5th"* "st"*'. Returns None when the
+    input has no words.
+    """
+    words = re.findall(r"\w+", expr)
+    if not words:
+        return None
+    terms = " ".join('"{}"*'.format(w) for w in words)
+    return "{%s} : (%s)" % (column, terms) if column else terms
+
+
+def search(name, expr, column=None, limit=LIMIT):
+    """
+    Rows of the table behind the index `name` matching expr, best ranked
+    first. With a column only that column is searched.
+    """
+    match = query(expr, column)
+    if match is None:
+        return []
+    return db.run("search:" + name, [match, limit]).fetchall()
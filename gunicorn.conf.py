@@ -0,0 +1,65 @@
+# Production server settings, see README.md
+#   gunicorn -c gunicorn.conf.py wsgi:APP
+# Every value can be overridden with an environment variable.
+import logging
+import multiprocessing
+import os
+
+bind = os.environ.get("BIND", "0.0.0.0:9001")
+
+# Pre-forked worker processes, each serving requests from a pool of threads
+workers = int(os.environ.get("WORKERS", multiprocessing.cpu_count()))
+worker_class = "gthread"
+threads = int(os.environ.get("THREADS", 4))
+
+# Workers are recycled after this many requests. On SIGHUP they are replaced
+# one by one and get graceful_timeout seconds to finish the running requests.
+max_requests = int(os.environ.get("MAX_REQUESTS", 10000))
+max_requests_jitter = max_requests // 10
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", 30))
+timeout = int(os.environ.get("TIMEOUT", 60))
+
+accesslog = os.environ.get("ACCESS_LOG", "-")
+
+# The workers only read the database: opened read-only and, unless
+# IMMUTABLE=0, immutable so they take no locks. Every connection maps up to
+# MMAP_SIZE bytes of the file and caches CACHE_KIB KiB of pages on its own.
+database = os.environ.get("DATABASE", "data.db")
+immutable = os.environ.get("IMMUTABLE", "1") != "0"
+mmap_size = int(os.environ.get("MMAP_SIZE", 1024 * 1024 * 1024))
+cache_kib = int(os.environ.get("CACHE_KIB", 16 * 1024))
+
+
+def when_ready(server):
+    # Runs in the master before the workers are forked: reads the hot pages
+    # of the database into the OS page cache they all share
+    import db
+
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+    db.warm(database, mmap_size)
+
+
+def post_worker_init(worker):
+    # Connections are opened in every worker after the fork, sqlite
+    # connections must never be shared between processes
+    import adb
+    import dashboard
+    import db
+
+    logging.basicConfig(
+        level=os.environ.get("LOG_LEVEL", "INFO"),
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    # With ASYNC_VIEWS=1 views also run queries on adb's threads, on top of the
+    # request ones
+    db.connect(
+        database,
+        pool_size=threads + adb.MAX_WORKERS,
+        readonly=True,
+        immutable=immutable,
+        cache_kib=cache_kib,
+        mmap_size=mmap_size,
+    )
+    dashboard.refresh()
+    dashboard.start_refresher()
@@ -0,0 +1,163 @@
+from collections import deque
+import functools
+import logging
+import os
+import re
+import threading
+import time
+
+from flask import g, jsonify, request
+import cache
+import db
+
+
+# Statements slower than this many milliseconds are logged and kept, with
+# their query plan, in the slow query log
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 100))
+# Upper bounds of the latency histogram buckets, in milliseconds
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+# Number of slow statements kept
+SLOW_LOG = 100
+
+# normalized sql -> stats, endpoint -> stats
+_queries = {}
+_routes = {}
+# (ms, sql, args, time)
+_slow = deque(maxlen=SLOW_LOG)
+# (generation, sql) -> EXPLAIN QUERY PLAN rows
+_plans = {}
+_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize(sql):
+    # Collapses whitespace and replaces literals by ?, so statements built
+    # with different values are counted together
+    sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    sql = re.sub(r"\b\d+(?:\.\d+)?\b", "?", sql)
+    return re.sub(r"\s+", " ", sql).strip()
+
+
+def _new():
+    return {
+        "calls": 0,
+        "rows": 0,
+        "total_ms": 0.0,
+        "max_ms": 0.0,
+        "histogram": [0] * (len(BUCKETS_MS) + 1),
+    }
+
+
+def _add(stats, ms, rows=0):
+    stats["calls"] += 1
+    stats["rows"] += rows
+    stats["total_ms"] += ms
+    stats["max_ms"] = max(stats["max_ms"], ms)
+    for i, bound in enumerate(BUCKETS_MS):
+        if ms <= bound:
+            break
+    else:
+        i = len(BUCKETS_MS)
+    stats["histogram"][i] += 1
+
+
+def record_query(sql, args, ms, rows):
+    """
+    Called by db.Cursor once a statement is fetched to the end, its cursor
+    closed or its connection given back to the pool.
+    ms covers executing the statement and fetching its rows.
+    """
+    key = normalize(sql)
+    with _lock:
+        stats = _queries.get(key)
+        if stats is None:
+            stats = _queries[key] = _new()
+        _add(stats, ms, rows)
+        if ms >= SLOW_QUERY_MS:
+            _slow.append((ms, sql, args, time.time()))
+    if ms >= SLOW_QUERY_MS:
+        logging.warning(
+            "Slow query ({:.1f}ms, {} rows): {} Args: {}".format(ms, rows, key, args)
+        )
+
+
+def _plan(sql, args):
+    # Plans are taken when /_metrics is read rather than on the slow path,
+    # they only change when a new database is imported
+    key = (db.DB["generation"], sql)
+    if key not in _plans:
+        if len(_plans) >= SLOW_LOG:
+            _plans.clear()
+        try:
+            rows = db._conn().execute("EXPLAIN QUERY PLAN " + sql, args or ())
+            _plans[key] = [row["detail"] for row in rows]
+        except Exception as e:
+            _plans[key] = ["{}: {}".format(type(e).__name__, e)]
+    return _plans[key]
+
+
+def _summary(stats):
+    return dict(stats, mean_ms=stats["total_ms"] / max(stats["calls"], 1))
+
+
+def snapshot():
+    with _lock:
+        queries = {sql: _summary(s) for sql, s in _queries.items()}
+        routes = {endpoint: _summary(s) for endpoint, s in _routes.items()}
+        slow = list(_slow)
+    return {
+        "buckets_ms": list(BUCKETS_MS) + ["inf"],
+        "slow_query_ms": SLOW_QUERY_MS,
+        "routes": routes,
+        "queries": dict(
+            sorted(queries.items(), key=lambda q: q[1]["total_ms"], reverse=True)
+        ),
+        "slow": [
+            {
+                "ms": ms,
+                "sql": normalize(sql),
+                "args": list(args) if args is not None else None,
+                "at": at,
+                "plan": _plan(sql, args),
+            }
+            for ms, sql, args, at in sorted(slow, key=lambda s: s[0], reverse=True)
+        ],
+    }
+
+
+def reset():
+    with _lock:
+        _queries.clear()
+        _routes.clear()
+        _slow.clear()
+
+
+def _before():
+    g.metrics_start = time.perf_counter()
+
+
+def _teardown(exc=None):
+    start = g.pop("metrics_start", None)
+    if start is None or request.endpoint is None:
+        return
+    ms = (time.perf_counter() - start) * 1000
+    with _lock:
+        stats = _routes.get(request.endpoint)
+        if stats is None:
+            stats = _routes[request.endpoint] = _new()
+        _add(stats, ms)
+
+
+@cache.exempt
+def view_metrics():
+    return jsonify(snapshot())
+
+
+def init_app(app):
+    """
+    Times every request per endpoint and serves the route and query
+    statistics as JSON at /_metrics.
+    """
+    app.before_request(_before)
+    app.teardown_request(_teardown)
+    app.add_url_rule("/_metrics", "metrics", view_metrics)
@@ -0,0 +1,56 @@
+import functools
+import json
+
+import db
+
+
+# Number of occurrences kept in memory by get()
+CACHE_SIZE = 4096
+
+
+def _part(row, prefix, columns):
+    # Columns of one LEFT JOINed table, None when there was nothing to join
+    if row[prefix + columns[0]] is None:
+        return None
+    return {c: row[prefix + c] for c in columns}
+
+
+def fetch(id):
+    """
+    Full record of an occurrence with everything linked to it, in a single
+    query. Returns None if it does not exist.
+    """
+    row = db.run("ocorrencia", [id]).fetchone()
+
+    if row is None:
+        return None
+
+    return {
+        "ocorrencias": _part(
+            row, "", ["occId", "date_occ", "date_rptd", "lat", "lon"]
+        ),
+        "crimes": json.loads(row["crimes"]),
+        "vitimas": _part(
+            row, "v_", ["vitimaId", "idade", "sexo", "descendencia"]
+        ),
+        "areas": _part(row, "a_", ["areaId", "nome"]),
+        "locais": _part(
+            row, "l_", ["localId", "desc_local", "area", "lat", "lon", "morada"]
+        ),
+        "armas": _part(row, "r_", ["armaId", "desc_arma"]),
+    }
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _cached(id, generation):
+    return fetch(id)
+
+
+def get(id):
+    """
+    Same as fetch(), served from an LRU cache. The cache is keyed on the
+    generation of the database too, so a new import never serves old
+    records. Not on its inode, which a later import can get back.
+    """
+    db.reopen_if_replaced()
+    return _cached(id, db.DB["generation"])
@@ -0,0 +1,70 @@
+import base64
+import binascii
+import json
+
+from flask import abort, request
+
+
+# Upper bound for the per_page query argument
+MAX_PER_PAGE = 1000
+
+
+def encode(key):
+    """Turns the sort key of a row into an opaque url-safe cursor."""
+    data = json.dumps(list(key), separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def decode(token, size):
+    """Returns the sort key stored in a cursor, raises ValueError if it is invalid."""
+    try:
+        data = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        key = json.loads(data)
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError("invalid cursor") from e
+    if not isinstance(key, list) or len(key) != size:
+        raise ValueError("invalid cursor")
+    if not all(v is None or isinstance(v, (int, float, str)) for v in key):
+        raise ValueError("invalid cursor")
+    return key
+
+
+def paginate(rows, per_page, key, after=None, before=None):
+    """
+    Builds a page out of rows fetched with LIMIT per_page + 1 while seeking
+    from the given cursor. Rows fetched for a `before` cursor come in reverse
+    order and are flipped back here.
+
+    Returns (rows, next_cursor, prev_cursor), cursors are None at the ends.
+    """
+    more = len(rows) > per_page
+    rows = list(rows[:per_page])
+    if before is not None:
+        rows.reverse()
+        has_next, has_prev = True, more
+    else:
+        has_next, has_prev = more, after is not None
+
+    if not rows:
+        return rows, None, None
+    return (
+        rows,
+        encode(key(rows[-1])) if has_next else None,
+        encode(key(rows[0])) if has_prev else None,
+    )
+
+
+def page_args(key_size):
+    # Keyset pagination arguments of the request: page size and the cursor
+    # to seek from
+    per_page = request.args.get("per_page", default=100, type=int)
+    per_page = max(1, min(per_page, MAX_PER_PAGE))
+    cursors = []
+    for name in ("after", "before"):
+        token = request.args.get(name)
+        try:
+            cursors.append(None if token is None else decode(token, key_size))
+        except ValueError:
+            abort(400, "Cursor de paginação inválido.")
+    after, before = cursors
+    return per_page, after, before
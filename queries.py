@@ -0,0 +1,284 @@
+import re
+
+
+# Every statement run by the web app, executed by name with db.run(). They are
+# normalized once here, so each one is a single string that sqlite compiles
+# once per connection and keeps in its statement cache.
+_QUERIES = {
+    # Start page
+    "dashboard": """
+    SELECT * FROM
+      (SELECT COUNT() n_occur FROM Ocorrencias)
+    JOIN
+      (SELECT COUNT() n_armas FROM Armas)
+    JOIN
+      (SELECT COUNT() n_areas FROM Areas)
+    JOIN
+      (SELECT COUNT() n_locais FROM Locais)
+    JOIN
+      (SELECT COUNT() n_vitimas FROM Vitimas)
+    JOIN
+      (SELECT COUNT() n_crimes FROM Crimes)
+    """,
+    # Rankings
+    "top_areas": """
+    select nome as area, count
+    from stats_areas
+    order by count desc
+    limit 5;
+    """,
+    "crime_name": """
+    select desc_crime as crime
+    from crimes
+    where crimeId = ?
+    """,
+    "top_armas": """
+    select desc_arma as arma, count
+    from stats_crime_arma natural join armas
+    where crimeId = ?
+    order by count desc
+    limit 10;
+    """,
+    "top_descendencia": """
+    select count, descendencia
+    from stats_crime_descendencia
+    where crimeId = ?
+    order by count desc
+    limit 3;
+    """,
+    "blade_crimes": """
+    SELECT crimeId, desc_crime, desc_arma
+    FROM armas natural join stats_crime_arma natural join crimes
+    where (armaId<211 and armaId>199) or (armaId=216)
+    group by crimeId;
+    """,
+    # Ocorrencias
+    "ocorrencias:first": """
+    SELECT occId, localId, armaId, vitimaId, date_occ, date_rptd
+    FROM ocorrencias
+    ORDER BY date_occ desc, occId desc
+    LIMIT ?
+    """,
+    "ocorrencias:after": """
+    SELECT occId, localId, armaId, vitimaId, date_occ, date_rptd
+    FROM ocorrencias
+    WHERE (date_occ, occId) < (?, ?)
+    ORDER BY date_occ desc, occId desc
+    LIMIT ?
+    """,
+    "ocorrencias:before": """
+    SELECT occId, localId, armaId, vitimaId, date_occ, date_rptd
+    FROM ocorrencias
+    WHERE (date_occ, occId) > (?, ?)
+    ORDER BY date_occ, occId
+    LIMIT ?
+    """,
+    # Occurrences picked by /ocorrencias/filter, occIds as a JSON array
+    "ocorrencias:ids": """
+    SELECT occId, localId, armaId, vitimaId, date_occ, date_rptd
+    FROM ocorrencias
+    WHERE occId IN (SELECT value FROM json_each(?))
+    """,
+    "ocorrencia": """
+    SELECT o.occId, o.date_occ, o.date_rptd, o.lat, o.lon,
+      v.vitimaId AS v_vitimaId, v.idade AS v_idade, s.sexo AS v_sexo,
+      d.descendencia AS v_descendencia,
+      l.localId AS l_localId, l.desc_local AS l_desc_local,
+      a.nome AS l_area, l.lat AS l_lat, l.lon AS l_lon, l.morada AS l_morada,
+      a.areaId AS a_areaId, a.nome AS a_nome,
+      r.armaId AS r_armaId, r.desc_arma AS r_desc_arma,
+      (SELECT json_group_array(json_object('crimeId', crimeId, 'desc_crime', desc_crime))
+       FROM (SELECT crimeId, desc_crime
+             FROM occ_crime NATURAL JOIN crimes
+             WHERE occId = o.occId
+             ORDER BY crimeId)) AS crimes
+    FROM Ocorrencias o
+      LEFT JOIN Vitimas v ON v.vitimaId = o.vitimaId
+      LEFT JOIN Sexos s ON s.sexoId = v.sexoId
+      LEFT JOIN Descendencias d ON d.descendenciaId = v.descendenciaId
+      LEFT JOIN Locais l ON l.localId = o.localId
+      LEFT JOIN Areas a ON a.areaId = o.areaId
+      LEFT JOIN Armas r ON r.armaId = o.armaId
+    WHERE o.occId = ?
+    """,
+    # Areas
+    "areas": """
+    SELECT areaId, nome
+    FROM Areas
+    ORDER BY areaId
+    """,
+    "area": """
+    SELECT areaId, nome
+    FROM Areas
+    WHERE areaId = ?
+    ORDER BY nome
+    """,
+    "area_locais": """
+    SELECT localId, desc_local
+    FROM Areas NATURAL JOIN Locais
+    WHERE areaId = ?
+    ORDER by localId
+    """,
+    "area_total": """
+    SELECT count
+    FROM stats_areas
+    WHERE areaId = ?
+    """,
+    # Crimes
+    "crimes": """
+    SELECT crimeId, desc_crime
+    FROM Crimes
+    ORDER BY crimeId
+    """,
+    "crime": """
+    SELECT crimeId, desc_crime
+    FROM Crimes
+    WHERE crimeId = ?
+    """,
+    "crime_total": """
+    SELECT COUNT()
+    FROM occ_crime
+    WHERE crimeId = ?
+    """,
+    # Locais
+    "locais": """
+    SELECT localId, lat, lon, morada, desc_local, areaId
+    FROM Locais NATURAL JOIN Areas
+    ORDER BY desc_local
+    """,
+    "local": """
+    SELECT localId, lat, lon, morada, desc_local, areaId
+    FROM Locais
+    WHERE localId = ?
+    """,
+    "local_total": """
+    SELECT COUNT()
+    FROM Ocorrencias
+    WHERE localId = ?
+    """,
+    # Vitimas
+    "vitimas:first": """
+    SELECT vitimaId, idade, sexo, descendencia
+    FROM Vitimas NATURAL LEFT JOIN Sexos NATURAL LEFT JOIN Descendencias
+    order by vitimaId
+    LIMIT ?
+    """,
+    "vitimas:after": """
+    SELECT vitimaId, idade, sexo, descendencia
+    FROM Vitimas NATURAL LEFT JOIN Sexos NATURAL LEFT JOIN Descendencias
+    WHERE vitimaId > ?
+    order by vitimaId
+    LIMIT ?
+    """,
+    "vitimas:before": """
+    SELECT vitimaId, idade, sexo, descendencia
+    FROM Vitimas NATURAL LEFT JOIN Sexos NATURAL LEFT JOIN Descendencias
+    WHERE vitimaId < ?
+    order by vitimaId desc
+    LIMIT ?
+    """,
+    "vitima": """
+    SELECT vitimaId, idade, sexo, descendencia
+    FROM Vitimas NATURAL LEFT JOIN Sexos NATURAL LEFT JOIN Descendencias
+    WHERE vitimaId = ?
+    """,
+    "vitima_total": """
+    SELECT COUNT()
+    FROM Ocorrencias
+    WHERE vitimaId = ?
+    """,
+    # Armas
+    "armas": """
+    SELECT armaId, desc_arma
+    FROM Armas
+    ORDER BY armaId
+    """,
+    "arma": """
+    SELECT armaId, desc_arma
+    FROM  Armas
+    WHERE armaId = ?
+    ORDER BY armaId
+    """,
+    "arma_total": """
+    SELECT COUNT()
+    FROM Ocorrencias
+    WHERE armaId = ?
+    """,
+    # JSON API
+    "api_area_exists": "SELECT 1 FROM Areas WHERE areaId = ?",
+    "api_crime_exists": "SELECT 1 FROM Crimes WHERE crimeId = ?",
+    "api_arma_exists": "SELECT 1 FROM Armas WHERE armaId = ?",
+    "api_area_ocorrencias": """
+    SELECT occId, localId, armaId, vitimaId, date_occ, date_rptd
+    FROM Ocorrencias
+    WHERE areaId = ?
+    ORDER BY date_occ, occId
+    """,
+    "api_crime_ocorrencias": """
+    SELECT occId, localId, armaId, vitimaId, date_occ, date_rptd
+    FROM occ_crime NATURAL JOIN Ocorrencias
+    WHERE crimeId = ?
+    ORDER BY date_occ, occId
+    """,
+    "api_arma_ocorrencias": """
+    SELECT occId, localId, armaId, vitimaId, date_occ, date_rptd
+    FROM Ocorrencias
+    WHERE armaId = ?
+    ORDER BY date_occ, occId
+    """,
+}
+
+# Occurrences shown on the area, crime, place, victim and weapon pages, sorted
+# by date_occ. Every one is "SELECT ... WHERE ..." returning occId and
+# date_occ, registered as name:first, name:after and name:before with the
+# keyset condition, ORDER BY and LIMIT of app.ocorrencias_page() added.
+_PAGES = {
+    "area_ocorrencias": """
+    SELECT occId, date_occ, date_rptd
+    FROM Ocorrencias
+    WHERE areaId = ?
+    """,
+    "crime_ocorrencias": """
+    SELECT occId, date_occ, date_rptd
+    FROM occ_crime NATURAL JOIN Ocorrencias
+    WHERE crimeId = ?
+    """,
+    "local_ocorrencias": """
+    SELECT occId, date_occ
+    FROM Ocorrencias
+    WHERE localId = ?
+    """,
+    "vitima_ocorrencias": """
+    SELECT occId, date_occ, date_rptd
+    FROM Ocorrencias
+    WHERE vitimaId = ?
+    """,
+    "arma_ocorrencias": """
+    SELECT occId, date_occ, date_rptd
+    FROM Ocorrencias
+    WHERE armaId = ?
+    """,
+}
+
+_KEYSET = {
+    "first": " ORDER BY date_occ, occId LIMIT ?",
+    "after": " AND (date_occ, occId) > (?, ?) ORDER BY date_occ, occId LIMIT ?",
+    "before": " AND (date_occ, occId) < (?, ?)"
+    " ORDER BY date_occ desc, occId desc LIMIT ?",
+}
+
+for name, sql in _PAGES.items():
+    for variant, suffix in _KEYSET.items():
+        _QUERIES["{}:{}".format(name, variant)] = sql + suffix
+
+
+def normalize(sql):
+    return re.sub(r"\s+", " ", sql).strip()
+
+
+QUERIES = {name: normalize(sql) for name, sql in _QUERIES.items()}
+
+
+def register(name, sql):
+    # For statements generated by other modules, eg. the searches of fts.py
+    QUERIES[name] = normalize(sql)
@@ -0,0 +1,145 @@
+from datetime import datetime
+import logging
+from sqlite3 import Connection
+
+import queries
+
+
+# Occurrence counts per time bucket, built by write_to_db.py and kept up to
+# date by incremental imports. name -> (bucket, bucket expression, key, source)
+ROLLUPS = {
+    # occurrences per day and area
+    "day_area": (
+        "day",
+        "substr(date_occ, 1, 10)",
+        "areaId",
+        "ocorrencias",
+    ),
+    # crimes per hour and crime
+    "hour_crime": (
+        "hour",
+        "substr(date_occ, 1, 13)",
+        "crimeId",
+        "occ_crime",
+    ),
+    # occurrences per month and weapon
+    "month_arma": ("month", "substr(date_occ, 1, 7)", "armaId", "ocorrencias"),
+}
+
+# Coarser groupings a series can be read in, as an expression over the
+# bucket. Only the ones at least as coarse as the bucket apply.
+GROUPS = {
+    "hour": "bucket",
+    "day": "substr(bucket, 1, 10)",
+    "month": "substr(bucket, 1, 7)",
+    "year": "substr(bucket, 1, 4)",
+    "hour_of_day": "substr(bucket, 12, 2)",
+}
+_LENGTHS = {"hour": 13, "day": 10, "month": 7, "year": 4}
+
+
+def groups(name):
+    # Groupings available for a rollup, its own bucket first
+    bucket = ROLLUPS[name][0]
+    return [bucket] + [
+        g
+        for g in GROUPS
+        if g != bucket
+        and (
+            (g in _LENGTHS and _LENGTHS[g] < _LENGTHS[bucket])
+            or (g == "hour_of_day" and bucket == "hour")
+        )
+    ]
+
+
+def _table(name):
+    return "rollup_" + name
+
+
+def _select(name, where):
+    # (bucket, key, count) of the occurrences matching where
+    _, bucket, key, source = ROLLUPS[name]
+    return f"""
+        SELECT {bucket} AS bucket, {key}, COUNT(*) AS n
+        FROM {source}
+        WHERE {key} IS NOT NULL AND {where}
+        GROUP BY 1, 2
+        """
+
+
+def build(con: Connection):
+    for name, (_, _, key, _) in ROLLUPS.items():
+        table = _table(name)
+        logging.info(f"Creating {table}...")
+        con.execute(f"DROP TABLE IF EXISTS {table}")
+        con.execute(
+            f"""
+            CREATE TABLE {table} (
+                bucket TEXT, {key} INTEGER, count INTEGER,
+                PRIMARY KEY ({key}, bucket)
+            ) WITHOUT ROWID
+            """
+        )
+        con.execute(f"INSERT INTO {table} {_select(name, 'true')}")
+        con.execute(f"CREATE INDEX {table}_bucket ON {table}(bucket)")
+
+
+_DELTA = "occId IN (SELECT occId FROM delta)"
+
+
+def subtract(con: Connection):
+    """
+    Takes the occurrences listed in the temp table delta out of the
+    rollups, before an incremental import overwrites them.
+    """
+    for name, (_, _, key, _) in ROLLUPS.items():
+        table = _table(name)
+        con.execute(
+            f"""
+            UPDATE {table} SET count = count - d.n
+            FROM ({_select(name, _DELTA)}) AS d
+            WHERE {table}.{key} = d.{key} AND {table}.bucket = d.bucket
+            """
+        )
+        con.execute(f"DELETE FROM {table} WHERE count <= 0")
+
+
+def add(con: Connection):
+    # Counts the occurrences listed in delta, once they are written
+    for name, (_, _, key, _) in ROLLUPS.items():
+        con.execute(
+            f"""
+            INSERT INTO {_table(name)} {_select(name, _DELTA)}
+            ON CONFLICT DO UPDATE SET count = count + excluded.count
+            """
+        )
+
+
+# One statement per rollup, grouping and whether a key is given, eg.
+# "series:day_area:month:one"
+for name, (_, _, key, _) in ROLLUPS.items():
+    for group in groups(name):
+        for which, condition in (("one", f"{key} = ? AND "), ("all", "")):
+            queries.register(
+                f"series:{name}:{group}:{which}",
+                f"""
+                SELECT {GROUPS[group]} AS bucket, SUM(count) AS count
+                FROM {_table(name)}
+                WHERE {condition}bucket >= ? AND bucket < ?
+                GROUP BY 1
+                ORDER BY 1
+                """,
+            )
+
+
+def series_args(name, since=None, until=None):
+    """
+    Bucket range of a series from since up to until, dates as "YYYY-MM-DD".
+    The bucket holding since is included, the one holding until is not.
+    Raises ValueError for malformed dates.
+    """
+    for date in (since, until):
+        if date is not None:
+            datetime.strptime(date, "%Y-%m-%d")
+    length = _LENGTHS[ROLLUPS[name][0]]
+    return [(since or "0000")[:length], (until or "9999")[:length]]
@@ -0,0 +1,60 @@
+import logging
+import time
+from typing import Tuple
+from sqlite3 import Connection, OperationalError
+
+
+# Version of the schema built by write_to_db.py, stored in PRAGMA user_version.
+# Bump it whenever the tables, INDEXES below, aggregates.TABLES,
+# fts.INDEXES, spatial.py or rollups.ROLLUPS change.
+VERSION = 7
+
+# Secondary indexes, derived from the queries in app.py
+INDEXES = {
+    # /ocorrencias/ keyset pagination
+    "ocorrencias_date_occ": "ocorrencias(date_occ, occId)",
+    # Ocorrencias of an area, place, weapon or victim, already sorted for
+    # the "ORDER BY date_occ" of the detail pages
+    "ocorrencias_areaId": "ocorrencias(areaId, date_occ, occId)",
+    "ocorrencias_localId": "ocorrencias(localId, date_occ, occId)",
+    "ocorrencias_armaId": "ocorrencias(armaId, date_occ, occId)",
+    "ocorrencias_vitimaId": "ocorrencias(vitimaId, date_occ, occId)",
+    # /crimes/<id>/, /top_armas/<id>, /top_descendencia/<id>
+    "occ_crime_crimeId": "occ_crime(crimeId, date_occ, occId)",
+    # /areas/<id>/ places
+    "locais_areaId": "locais(areaId)",
+}
+
+
+def build(con: Connection, rebuild: bool = True):
+    # Without rebuild only missing indexes are created
+    for name, target in INDEXES.items():
+        logging.info(f"Creating index {name} on {target}...")
+        if rebuild:
+            con.execute(f"DROP INDEX IF EXISTS {name}")
+        con.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+    logging.info("Analyzing...")
+    con.execute("ANALYZE")
+    con.execute(f"PRAGMA user_version = {VERSION}")
+
+
+def version(con: Connection) -> int:
+    return con.execute("PRAGMA user_version").fetchone()[0]
+
+
+def stamp(con: Connection, generation: int):
+    # Marks the data as a new generation, used by the app to invalidate caches
+    con.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+    con.executemany(
+        "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+        [("generation", generation), ("built_at", time.time())],
+    )
+
+
+def generation(con: Connection) -> Tuple[int, float]:
+    """Returns (generation, built_at timestamp), (0, 0) if never stamped."""
+    try:
+        meta = dict(con.execute("SELECT key, value FROM meta"))
+    except OperationalError:
+        return 0, 0.0
+    return int(meta.get("generation", 0)), float(meta.get("built_at", 0.0))
@@ -1,5 +1,6 @@
 import logging
 from app import APP
+import dashboard
 import db
 
 if __name__ == "__main__":
@@ -9,6 +10,8 @@ if __name__ == "__main__":
         datefmt="%Y-%m-%d %H:%M:%S",
     )
     db.connect()
+    dashboard.refresh()
+    dashboard.start_refresher()
     APP.run(
         host="0.0.0.0",
         port=9001,
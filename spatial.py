@@ -0,0 +1,110 @@
+from datetime import datetime
+import logging
+import math
+from sqlite3 import Connection
+
+import queries
+
+
+# R*Tree over the coordinates and date of every occurrence, built by
+# write_to_db.py after every import. Dates are days since 1970-01-01, so one
+# index answers "in this box between these dates".
+NAME = "ocorrencias_rtree"
+
+# Day bound used without a date, the R*Tree does not match against infinity
+NO_LIMIT = 1e9
+
+# Meters per degree of latitude
+METERS_PER_DEGREE = 111_320
+
+# Rows of the box are refined on the exact coordinates and date, the R*Tree
+# only stores them as 32 bit floats
+_SELECT = """
+    SELECT o.occId, o.localId, o.armaId, o.vitimaId, o.date_occ, o.date_rptd,
+      o.lat, o.lon
+    FROM {name} r JOIN ocorrencias o ON o.occId = r.occId
+    WHERE r.min_lat <= :max_lat AND r.max_lat >= :min_lat
+      AND r.min_lon <= :max_lon AND r.max_lon >= :min_lon
+      AND r.min_day <= :max_day AND r.max_day >= :min_day
+      AND o.lat BETWEEN :min_lat AND :max_lat
+      AND o.lon BETWEEN :min_lon AND :max_lon
+      AND o.date_occ >= :since AND o.date_occ < :until
+    """.format(name=NAME)
+
+queries.register("spatial_box", _SELECT + " ORDER BY o.date_occ, o.occId")
+queries.register(
+    "spatial_near",
+    _SELECT
+    + """
+      AND :radius >= 6371008.8 * acos(min(1,
+        sin(radians(o.lat)) * sin(radians(:lat))
+        + cos(radians(o.lat)) * cos(radians(:lat)) * cos(radians(o.lon - :lon))))
+    ORDER BY o.date_occ, o.occId
+    """,
+)
+
+
+def build(con: Connection):
+    logging.info(f"Creating {NAME}...")
+    con.execute(f"DROP TABLE IF EXISTS {NAME}")
+    con.execute(
+        f"""
+        CREATE VIRTUAL TABLE {NAME} USING rtree(
+            occId, min_lat, max_lat, min_lon, max_lon, min_day, max_day
+        )
+        """
+    )
+    con.execute(
+        f"""
+        INSERT INTO {NAME}
+        SELECT occId, lat, lat, lon, lon, day, day
+        FROM (SELECT occId, lat, lon, julianday(date_occ) - 2440587.5 AS day
+              FROM ocorrencias
+              WHERE lat IS NOT NULL AND lon IS NOT NULL)
+        """
+    )
+
+
+def _date(date, default):
+    # "YYYY-MM-DD[ hh:mm]" -> (date as stored in date_occ, days since
+    # 1970-01-01), default for no limit
+    if date is None:
+        return default
+    date = datetime.fromisoformat(date)
+    return str(date), (date - datetime(1970, 1, 1)).total_seconds() / 86400
+
+
+def box(min_lat, min_lon, max_lat, max_lon, since=None, until=None):
+    """
+    Arguments of the spatial_box query: occurrences inside the box that
+    happened in [since, until), dates as "YYYY-MM-DD" or None for no limit.
+    Raises ValueError for malformed dates or boxes.
+    """
+    if min_lat > max_lat or min_lon > max_lon:
+        raise ValueError("empty box")
+    since, min_day = _date(since, ("0000-01-01 00:00:00", -NO_LIMIT))
+    until, max_day = _date(until, ("9999-12-31 23:59:59", NO_LIMIT))
+    return {
+        "min_lat": min_lat,
+        "min_lon": min_lon,
+        "max_lat": max_lat,
+        "max_lon": max_lon,
+        "min_day": min_day,
+        "max_day": max_day,
+        "since": since,
+        "until": until,
+    }
+
+
+def near(lat, lon, radius, since=None, until=None):
+    """
+    Arguments of the spatial_near query: occurrences within radius meters of
+    lat, lon, searched in the box around the circle.
+    """
+    if radius < 0 or not -90 <= lat <= 90:
+        raise ValueError("invalid circle")
+    dlat = radius / METERS_PER_DEGREE
+    dlon = radius / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+    args = box(lat - dlat, lon - dlon, lat + dlat, lon + dlon, since, until)
+    args.update(lat=lat, lon=lon, radius=radius)
+    return args
@@ -1,11 +1,124 @@
-from typing import List, Literal, Tuple
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Literal, Optional, Tuple
+import argparse
+import io
+import os
 import pandas as pd
 import logging
+import time
 from sqlite3 import Connection, connect
+import aggregates
+import columnar
+import fts
+import rollups
+import schema
+import spatial
 
 
-# Set this to False to not run extremely slow stuff
-SLOW = True
+CSV_PATH = "Crime_Data_from_2020_to_Present.csv"
+DB_PATH = "data.db"
+
+# Columns of the csv used by the import and how to read them. Nullable codes
+# use pandas' Int64 so they stay integers instead of turning into floats.
+DTYPES = {
+    "DR_NO": "int64",
+    "Date Rptd": "str",
+    "DATE OCC": "str",
+    "TIME OCC": "int64",
+    "AREA": "int64",
+    "AREA NAME": "str",
+    "Crm Cd": "Int64",
+    "Crm Cd Desc": "str",
+    "Vict Age": "Int64",
+    "Vict Sex": "str",
+    "Vict Descent": "str",
+    "Premis Cd": "Int64",
+    "Premis Desc": "str",
+    "Weapon Used Cd": "Int64",
+    "Weapon Desc": "str",
+    "Crm Cd 1": "Int64",
+    "Crm Cd 2": "Int64",
+    "LOCATION": "str",
+    "LAT": "float64",
+    "LON": "float64",
+}
+
+# Categorical columns stored as small integer codes, the values live in a
+# code table each. csv column -> (table, code column, value column)
+CODES = {
+    "Vict Sex": ("sexos", "sexoId", "sexo"),
+    "Vict Descent": ("descendencias", "descendenciaId", "descendencia"),
+}
+
+# Size of the pieces of the csv handed to every worker of a parallel import
+PARTITION_BYTES = 16 * 1024 * 1024
+
+# stage -> [rows, seconds] for every stage of the last import, summed over
+# all chunks when streaming
+TIMINGS: Dict[str, List] = {}
+
+
+@contextmanager
+def stage(name: str, rows: int = 0):
+    # Times a step of the import, the row count can be set on the yielded dict
+    # when it is only known at the end
+    logging.info(f"{name}...")
+    timing = {"rows": rows}
+    start = time.perf_counter()
+    yield timing
+    elapsed = time.perf_counter() - start
+    total = TIMINGS.setdefault(name, [0, 0.0])
+    total[0] += timing["rows"]
+    total[1] += elapsed
+    logging.info(
+        f"{name}: {timing['rows']} rows in {elapsed:.2f}s "
+        f"({timing['rows'] / max(elapsed, 1e-9):.0f} rows/s)"
+    )
+
+
+def parse_dates(df: pd.DataFrame):
+    # "MM/DD/YYYY hh:mm:ss AM" date + "HHMM" time, parsed in one go
+    time_occ = df["TIME OCC"].astype(str).str.zfill(4)
+    df["DATE OCC"] = pd.to_datetime(
+        df["DATE OCC"].str[:10] + " " + time_occ,
+        format="%m/%d/%Y %H%M",
+    )
+    df["Date Rptd"] = df["Date Rptd"].str[:10].str.replace("/", "-", regex=False)
+
+
+def _insert(verb: str, table, conn, keys: List[str], data_iter: Iterable):
+    columns = ", ".join(f'"{k}"' for k in keys)
+    params = ", ".join("?" for _ in keys)
+    conn.executemany(
+        f'{verb} INTO "{table.name}" ({columns}) VALUES ({params})',
+        data_iter,
+    )
+
+
+def insert_or_ignore(table, conn, keys: List[str], data_iter: Iterable):
+    # to_sql insert method: rows whose key is already stored are skipped, so
+    # the first row seen for a key wins like with drop_duplicates
+    _insert("INSERT OR IGNORE", table, conn, keys, data_iter)
+
+
+def insert_or_replace(table, conn, keys: List[str], data_iter: Iterable):
+    # to_sql insert method: rows whose key is already stored are overwritten
+    _insert("INSERT OR REPLACE", table, conn, keys, data_iter)
+
+
+def upsert_crime(table, conn, keys: List[str], data_iter: Iterable):
+    # Like insert_or_ignore, but a crime first seen as "Crm Cd 2" (without a
+    # description) gets its description once it shows up as "Crm Cd"
+    columns = ", ".join(f'"{k}"' for k in keys)
+    params = ", ".join("?" for _ in keys)
+    conn.executemany(
+        f'INSERT INTO "{table.name}" ({columns}) VALUES ({params}) '
+        "ON CONFLICT(crimeId) DO UPDATE SET desc_crime = excluded.desc_crime "
+        "WHERE desc_crime = 'Unknown'",
+        data_iter,
+    )
 
 
 def to_sql(
@@ -16,6 +129,7 @@ def to_sql(
     primary_keys: List[str] = [],
     foreign_keys: List[Tuple[str, str]] = [],
     if_exists: Literal["fail", "replace", "append"] = "replace",
+    method=None,
 ):
     dtypes = {}
     dtypes[primary_keys[0]] = "INTEGER PRIMARY KEY"
@@ -39,63 +153,255 @@ def to_sql(
         con=con,
         index=False,
         if_exists=if_exists,
+        method=method,
+    )
+
+
+def read_csv(csv_path: str, chunksize: Optional[int] = None):
+    return pd.read_csv(
+        csv_path,
+        usecols=list(DTYPES),
+        dtype=DTYPES,
+        chunksize=chunksize,
+    )
+
+
+def read_chunks(csv_path: str, chunksize: int) -> Iterator[pd.DataFrame]:
+    chunks = read_csv(csv_path, chunksize)
+    while True:
+        with stage("Reading csv") as timing:
+            df = next(chunks, None)
+            timing["rows"] = 0 if df is None else len(df)
+        if df is None:
+            return
+        yield df
+
+
+def normalize(df: pd.DataFrame):
+    df["Vict Descent"] = df["Vict Descent"].replace(
+        to_replace={
+            "B": "Preto",
+            "H": "Hispânico",
+            "X": "Outro",
+            "W": "Branco",
+            "A": "Asiático",
+            "O": "Ocidental",
+            "C": "Outro",
+            "F": "Outro",
+            "K": "Koreano",
+            "I": "Indiano",
+            "V": "Outro",
+            "Z": "Outro",
+            "J": "Outro",
+            "P": "Outro",
+            "G": "Outro",
+            "U": "Outro",
+            "D": "Outro",
+            "S": "Outro",
+            "L": "Outro",
+            "-": "Outro",
+        }
     )
+    df["Vict Descent"] = df["Vict Descent"].fillna("Outro")
+    df["Vict Sex"] = df["Vict Sex"].replace(
+        to_replace={
+            "X": "Unknown",
+            "H": "Unknown",
+            "-": "Unknown",
+        }
+    )
+    df["Vict Sex"] = df["Vict Sex"].fillna("Unknown")
+    df["Premis Desc"] = df["Premis Desc"].fillna("Unknown")
+    # The csv has 0, 0 for occurrences without coordinates
+    missing = (df["LAT"] == 0) | (df["LON"] == 0)
+    df.loc[missing, ["LAT", "LON"]] = None
+    parse_dates(df)
+
 
+def create_code_table(con: Connection, table: str, key: str, name: str):
+    con.execute(
+        f"CREATE TABLE IF NOT EXISTS {table} "
+        f"({key} INTEGER PRIMARY KEY, {name} TEXT NOT NULL UNIQUE)"
+    )
 
-def main():
-    df = pd.read_csv("Crime_Data_from_2020_to_Present.csv")
-
-    with connect("data.db") as con:
-        df["Vict Descent"] = df["Vict Descent"].replace(
-            to_replace={
-                "B": "Preto",
-                "H": "Hispânico",
-                "X": "Outro",
-                "W": "Branco",
-                "A": "Asiático",
-                "O": "Ocidental",
-                "C": "Outro",
-                "F": "Outro",
-                "K": "Koreano",
-                "I": "Indiano",
-                "V": "Outro",
-                "Z": "Outro",
-                "J": "Outro",
-                "P": "Outro",
-                "G": "Outro",
-                "U": "Outro",
-                "D": "Outro",
-                "S": "Outro",
-                "L": "Outro",
-                "-": "Outro",
-            }
-        )
-        df["Vict Descent"] = df["Vict Descent"].fillna("Outro")
-        df["Vict Sex"] = df["Vict Sex"].replace(
-            to_replace={
-                "X": "Unknown",
-                "H": "Unknown",
-                "-": "Unknown",
-            }
-        )
-        df["Vict Sex"] = df["Vict Sex"].fillna("Unknown")
-        df["Premis Desc"] = df["Premis Desc"].fillna("Unknown")
-
-        # Areas Table
-        logging.info("Creating areas table...")
+
+def encode(df: pd.DataFrame, con: Connection, replace: bool = False):
+    """
+    Adds a code column for every column of CODES, storing the values not
+    seen before in the code tables. Codes never change once assigned, so
+    incremental imports keep the stored ones.
+    """
+    for column, (table, key, name) in CODES.items():
+        if replace:
+            con.execute(f"DROP TABLE IF EXISTS {table}")
+        create_code_table(con, table, key, name)
+        con.executemany(
+            f"INSERT OR IGNORE INTO {table} ({name}) VALUES (?)",
+            ((v,) for v in sorted(df[column].unique())),
+        )
+        codes = dict(con.execute(f"SELECT {name}, {key} FROM {table}"))
+        df[key] = df[column].map(codes)
+
+
+def migrate(con: Connection):
+    """
+    Converts a database built before schema version 5 to the current
+    storage format, without reading the csv again: the "LAT LON" text of
+    locais.coordenadas becomes REAL lat and lon columns, the sexo and
+    descendencia text of vitimas becomes codes into sexos and descendencias
+    and ocorrencias gets lat and lon columns. Those are only filled by
+    importing the csv again. ocorrencias gets an areaId column, filled with
+    the area of the stored place until the csv is imported again, and
+    occ_crime a copy of the date_occ of its occurrence. Missing rollups are
+    built from the stored occurrences.
+    """
+    locais = {row[1] for row in con.execute("PRAGMA table_info(locais)")}
+    if "coordenadas" in locais:
+        logging.info("Migrating locais.coordenadas to lat, lon...")
+        con.execute("ALTER TABLE locais ADD COLUMN lat REAL")
+        con.execute("ALTER TABLE locais ADD COLUMN lon REAL")
+        con.execute(
+            """
+            UPDATE locais SET
+              lat = NULLIF(CAST(substr(coordenadas, 1, instr(coordenadas, ' ') - 1) AS REAL), 0),
+              lon = NULLIF(CAST(substr(coordenadas, instr(coordenadas, ' ') + 1) AS REAL), 0)
+            """
+        )
+        con.execute("ALTER TABLE locais DROP COLUMN coordenadas")
+
+    vitimas = {row[1] for row in con.execute("PRAGMA table_info(vitimas)")}
+    if "sexo" in vitimas:
+        logging.info("Migrating vitimas.sexo and descendencia to codes...")
+        for column, (table, key, name) in CODES.items():
+            create_code_table(con, table, key, name)
+            con.execute(
+                f"INSERT OR IGNORE INTO {table} ({name}) "
+                f"SELECT DISTINCT {name} FROM vitimas WHERE {name} IS NOT NULL "
+                f"ORDER BY {name}"
+            )
+        con.execute("DROP TABLE IF EXISTS vitimas_new")
+        con.execute(
+            """
+            CREATE TABLE vitimas_new (
+                vitimaId INTEGER PRIMARY KEY,
+                idade INTEGER,
+                sexoId INTEGER REFERENCES sexos(sexoId),
+                descendenciaId INTEGER REFERENCES descendencias(descendenciaId)
+            )
+            """
+        )
+        con.execute(
+            """
+            INSERT INTO vitimas_new
+            SELECT vitimaId, idade, sexoId, descendenciaId
+            FROM vitimas NATURAL LEFT JOIN sexos NATURAL LEFT JOIN descendencias
+            """
+        )
+        con.execute("DROP TABLE vitimas")
+        con.execute("ALTER TABLE vitimas_new RENAME TO vitimas")
+
+    ocorrencias = {row[1] for row in con.execute("PRAGMA table_info(ocorrencias)")}
+    if "lat" not in ocorrencias:
+        logging.warning(
+            "Adding ocorrencias.lat and lon, import the csv again to fill them"
+        )
+        con.execute("ALTER TABLE ocorrencias ADD COLUMN lat REAL")
+        con.execute("ALTER TABLE ocorrencias ADD COLUMN lon REAL")
+    if "areaId" not in ocorrencias:
+        # locais holds one area per kind of premises, not the area of every
+        # occurrence, which only the csv has
+        logging.warning(
+            "Adding ocorrencias.areaId from locais, import the csv again to "
+            "fill it with the area of every occurrence"
+        )
+        con.execute(
+            "ALTER TABLE ocorrencias ADD COLUMN areaId INTEGER REFERENCES areas(areaId)"
+        )
+        con.execute(
+            """
+            UPDATE ocorrencias SET areaId = l.areaId
+            FROM locais l WHERE l.localId = ocorrencias.localId
+            """
+        )
+
+    occ_crime = {row[1] for row in con.execute("PRAGMA table_info(occ_crime)")}
+    if "date_occ" not in occ_crime:
+        logging.info("Copying ocorrencias.date_occ to occ_crime...")
+        con.execute("ALTER TABLE occ_crime ADD COLUMN date_occ TIMESTAMP")
+        con.execute(
+            """
+            UPDATE occ_crime SET date_occ = o.date_occ
+            FROM ocorrencias o WHERE o.occId = occ_crime.occId
+            """
+        )
+
+    tables = {row[0] for row in con.execute("SELECT name FROM sqlite_master")}
+    if any("rollup_" + name not in tables for name in rollups.ROLLUPS):
+        rollups.build(con)
+
+
+def assign_vitima_ids(df: pd.DataFrame, con: Connection) -> Tuple[int, int]:
+    """
+    Gives occurrences already in the database their current vitimaId and new
+    ones ids after the largest stored id. The DR_NOs of the frame are left in
+    the temp table delta. Returns the number of existing and new occurrences.
+    """
+    con.execute("CREATE TEMP TABLE IF NOT EXISTS delta (occId INTEGER PRIMARY KEY)")
+    con.execute("DELETE FROM delta")
+    con.executemany(
+        "INSERT OR IGNORE INTO delta VALUES (?)", ((int(x),) for x in df["DR_NO"])
+    )
+    existing = dict(
+        con.execute("SELECT occId, vitimaId FROM ocorrencias NATURAL JOIN delta")
+    )
+    next_id = con.execute(
+        "SELECT COALESCE(MAX(vitimaId), -1) + 1 FROM vitimas"
+    ).fetchone()[0]
+
+    vitima_id = df["DR_NO"].map(existing)
+    new = vitima_id.isna()
+    vitima_id[new] = range(next_id, next_id + int(new.sum()))
+    df["vitimaId"] = vitima_id.astype("int64")
+    return len(existing), int(new.sum())
+
+
+def write_tables(
+    df: pd.DataFrame,
+    con: Connection,
+    mode: Literal["replace", "append", "upsert"] = "replace",
+):
+    """
+    Writes the rows of a normalized frame to every table.
+      replace: (re)creates the tables, used for the first frame of an import
+      append:  adds the rows, skipping keys that are already stored
+      upsert:  like append, but occurrences (and their victims and crimes)
+               that are already stored are overwritten and the rollups
+               updated. The frame must have a vitimaId column, see
+               assign_vitima_ids.
+    """
+    n = len(df)
+    if mode == "upsert":
+        with stage("Updating rollups", n):
+            rollups.subtract(con)
+    if_exists = "replace" if mode == "replace" else "append"
+    method = None if mode == "replace" else insert_or_ignore
+    fact_method = insert_or_replace if mode == "upsert" else method
+
+    # Areas Table
+    with stage("Creating areas table", n):
         to_sql(
             df[["AREA", "AREA NAME"]],
             "areas",
             con,
             renames={"AREA": "areaId", "AREA NAME": "nome"},
             primary_keys=["areaId"],
+            if_exists=if_exists,
+            method=method,
         )
 
-        # Locais Table
-        logging.info("Creating locais table...")
+    # Locais Table
+    with stage("Creating locais table", n):
         t = df[["Premis Cd", "AREA", "LOCATION", "Premis Desc", "LAT", "LON"]]
-        t = t.assign(coordenadas=t["LAT"].astype(str) + " " + t["LON"].astype(str))
-        t.drop(["LAT", "LON"], axis=1, inplace=True)
         to_sql(
             t,
             "locais",
@@ -105,49 +411,61 @@ def main():
                 "LOCATION": "morada",
                 "Premis Desc": "desc_local",
                 "AREA": "areaId",
+                "LAT": "lat",
+                "LON": "lon",
             },
             primary_keys=["localId"],
             foreign_keys=[("areaId", "areas(areaId)")],
+            if_exists=if_exists,
+            method=method,
         )
 
-        # Armas Table
-        logging.info("Creating armas table...")
+    # Armas Table
+    with stage("Creating armas table", n):
         to_sql(
             df[["Weapon Used Cd", "Weapon Desc"]],
             "armas",
             con,
             renames={"Weapon Used Cd": "armaId", "Weapon Desc": "desc_arma"},
             primary_keys=["armaId"],
+            if_exists=if_exists,
+            method=method,
         )
 
-        # Vitimas Table
-        logging.info("Creating vitimas table...")
-        df = df.assign(vitimaId=t.index)
-        t = df[["vitimaId", "Vict Age", "Vict Sex", "Vict Descent"]]
+    # Code tables
+    with stage("Creating code tables", n):
+        encode(df, con, replace=mode == "replace")
+
+    # Vitimas Table
+    with stage("Creating vitimas table", n):
+        if "vitimaId" not in df:
+            df = df.assign(vitimaId=t.index)
+        t = df[["vitimaId", "Vict Age", "sexoId", "descendenciaId"]]
         to_sql(
             t,
             "vitimas",
             con,
-            renames={
-                "Vict Age": "idade",
-                "Vict Sex": "sexo",
-                "Vict Descent": "descendencia",
-            },
+            renames={"Vict Age": "idade"},
             primary_keys=["vitimaId"],
+            foreign_keys=[
+                ("sexoId", "sexos(sexoId)"),
+                ("descendenciaId", "descendencias(descendenciaId)"),
+            ],
+            if_exists=if_exists,
+            method=fact_method,
         )
 
-        # Crimes Table
-        logging.info("Creating crimes table...")
+    # Crimes Table
+    with stage("Creating crimes table", n):
         crime_table = df[
-            ["Crm Cd", "Crm Cd 1", "Crm Cd 2", "Crm Cd Desc", "DR_NO"]
+            ["Crm Cd", "Crm Cd 1", "Crm Cd 2", "Crm Cd Desc", "DR_NO", "DATE OCC"]
         ].copy()
-        temp = crime_table[["DR_NO", "Crm Cd 2"]].rename(
+        temp = crime_table[["DR_NO", "Crm Cd 2", "DATE OCC"]].rename(
             {"Crm Cd 2": "Crm Cd"},
             axis="columns",
             copy=False,
             errors="raise",
         )
-        temp.drop_duplicates(["Crm Cd"], inplace=True)
         crime_table = pd.concat([crime_table, temp], ignore_index=True)
         crime_table["Crm Cd Desc"] = crime_table["Crm Cd Desc"].fillna("Unknown")
         to_sql(
@@ -156,33 +474,24 @@ def main():
             con,
             renames={"Crm Cd": "crimeId", "Crm Cd Desc": "desc_crime"},
             primary_keys=["crimeId"],
+            if_exists=if_exists,
+            method=None if mode == "replace" else upsert_crime,
         )
 
-        # Ocorrencias Table
-        logging.info("Creating ocorrencias table...")
-
-
-        if SLOW:
-            df["DATE OCC"] = pd.to_datetime(
-                df.apply(
-                    lambda row: f"{row['DATE OCC'][:11]} {row['TIME OCC']:04d}",
-                    axis=1,
-                ),
-                format="%m/%d/%Y %H%M",
-            )
-            df["Date Rptd"] = df["Date Rptd"].apply(
-                lambda row: f"{row[:10].replace('/', '-')}"
-            )
-
+    # Ocorrencias Table
+    with stage("Creating ocorrencias table", n):
         to_sql(
             df[
                 [
                     "DR_NO",
                     "vitimaId",
                     "Premis Cd",
+                    "AREA",
                     "Weapon Used Cd",
                     "DATE OCC",
                     "Date Rptd",
+                    "LAT",
+                    "LON",
                 ]
             ],
             "ocorrencias",
@@ -190,38 +499,49 @@ def main():
             renames={
                 "DR_NO": "occId",
                 "Premis Cd": "localId",
+                "AREA": "areaId",
                 "Weapon Used Cd": "armaId",
                 "DATE OCC": "date_occ",
                 "Date Rptd": "date_rptd",
+                "LAT": "lat",
+                "LON": "lon",
             },
             primary_keys=["occId"],
             foreign_keys=[
                 ("vitimaId", "vitimas(vitimaId)"),
                 ("localId", "locais(localId)"),
+                ("areaId", "areas(areaId)"),
                 ("armaId", "armas(armaId)"),
-            ]
+            ],
+            if_exists=if_exists,
+            method=fact_method,
         )
 
-        ## Occ-Crime
-        logging.info("Creating occ-crime table...")
-        cur = con.cursor()
-        cur.execute("DROP TABLE IF EXISTS occ_crime")
-        cur.execute(
-            """
-CREATE TABLE occ_crime (
-    occId    INTEGER REFERENCES ocorrencias (occId),
-    crimeId  INTEGER REFERENCES vitimas (vitimaId),
-    PRIMARY KEY (occId, crimeId)
-);
-                    """
-        )
+    ## Occ-Crime
+    with stage("Creating occ-crime table", n):
+        if mode == "upsert":
+            con.execute("DELETE FROM occ_crime WHERE occId IN (SELECT occId FROM delta)")
+        if mode == "replace":
+            cur = con.cursor()
+            cur.execute("DROP TABLE IF EXISTS occ_crime")
+            cur.execute(
+                """
+    CREATE TABLE occ_crime (
+        occId    INTEGER REFERENCES ocorrencias (occId),
+        crimeId  INTEGER REFERENCES vitimas (vitimaId),
+        date_occ TIMESTAMP,
+        PRIMARY KEY (occId, crimeId)
+    );
+                        """
+            )
         to_sql(
-            crime_table[["Crm Cd", "DR_NO"]],
+            crime_table[["Crm Cd", "DR_NO", "DATE OCC"]],
             "occ_crime",
             con,
             renames={
                 "DR_NO": "occId",
                 "Crm Cd": "crimeId",
+                "DATE OCC": "date_occ",
             },
             primary_keys=["occId", "crimeId"],
             foreign_keys=[
@@ -229,17 +549,356 @@ CREATE TABLE occ_crime (
                 ("crimeId", "crimes(crimeId)"),
             ],
             if_exists="append",
+            method=method,
         )
 
-        logging.info("Done!")
+    if mode == "upsert":
+        with stage("Updating rollups", n):
+            rollups.add(con)
+
+
+def partitions(csv_path: str, workers: int) -> List[Tuple[int, int]]:
+    """
+    Splits the csv after its header into (start, end) byte ranges that begin
+    at the start of a line. Records of this csv never span lines.
+    """
+    size = os.path.getsize(csv_path)
+    with open(csv_path, "rb") as f:
+        f.readline()
+        start = f.tell()
+        n = max(workers * 2, (size - start) // PARTITION_BYTES)
+        step = max((size - start) // n, 1)
+        bounds = [start]
+        while bounds[-1] < size:
+            f.seek(min(bounds[-1] + step, size))
+            f.readline()
+            bounds.append(min(f.tell(), size))
+    return list(zip(bounds, bounds[1:]))
+
+
+def project(df: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+    """
+    The rows of every table in a normalized frame, keyed on the table's
+    primary key with the first row winning like in write_tables. vitimaId is
+    the position of the row in the frame, vitimas keeps the csv's sex and
+    descent to be encoded by the writer.
+    """
+    def table(t, renames, keys):
+        t = t.rename(renames, axis="columns")
+        t = t.dropna(subset=keys)
+        return t.drop_duplicates(keys)
+
+    position = pd.RangeIndex(len(df))
+    date_occ = df["DATE OCC"].dt.strftime("%Y-%m-%d %H:%M:%S")
+    secondary = df[["DR_NO", "Crm Cd 2"]].rename({"Crm Cd 2": "Crm Cd"}, axis=1)
+    crimes = pd.concat(
+        [
+            df[["DR_NO", "Crm Cd", "Crm Cd Desc"]].assign(date_occ=date_occ),
+            secondary.assign(date_occ=date_occ),
+        ]
+    )
+    crimes["Crm Cd Desc"] = crimes["Crm Cd Desc"].fillna("Unknown")
+    return {
+        "areas": table(
+            df[["AREA", "AREA NAME"]],
+            {"AREA": "areaId", "AREA NAME": "nome"},
+            ["areaId"],
+        ),
+        "locais": table(
+            df[["Premis Cd", "AREA", "LOCATION", "Premis Desc", "LAT", "LON"]],
+            {
+                "Premis Cd": "localId",
+                "AREA": "areaId",
+                "LOCATION": "morada",
+                "Premis Desc": "desc_local",
+                "LAT": "lat",
+                "LON": "lon",
+            },
+            ["localId"],
+        ),
+        "armas": table(
+            df[["Weapon Used Cd", "Weapon Desc"]],
+            {"Weapon Used Cd": "armaId", "Weapon Desc": "desc_arma"},
+            ["armaId"],
+        ),
+        "vitimas": df[["Vict Age", "Vict Sex", "Vict Descent"]]
+        .rename({"Vict Age": "idade"}, axis="columns")
+        .assign(vitimaId=position.values),
+        "crimes": table(
+            crimes[["Crm Cd", "Crm Cd Desc"]],
+            {"Crm Cd": "crimeId", "Crm Cd Desc": "desc_crime"},
+            ["crimeId"],
+        ),
+        "ocorrencias": table(
+            df[
+                [
+                    "DR_NO",
+                    "Premis Cd",
+                    "AREA",
+                    "Weapon Used Cd",
+                    "Date Rptd",
+                    "LAT",
+                    "LON",
+                ]
+            ].assign(vitimaId=position.values, date_occ=date_occ),
+            {
+                "DR_NO": "occId",
+                "Premis Cd": "localId",
+                "AREA": "areaId",
+                "Weapon Used Cd": "armaId",
+                "Date Rptd": "date_rptd",
+                "LAT": "lat",
+                "LON": "lon",
+            },
+            ["occId"],
+        ),
+        "occ_crime": table(
+            crimes[["DR_NO", "Crm Cd", "date_occ"]],
+            {"DR_NO": "occId", "Crm Cd": "crimeId"},
+            ["occId", "crimeId"],
+        ),
+    }
+
+
+def transform(csv_path: str, start: int, end: int, header: bool):
+    """
+    Runs in a worker process: reads and normalizes the lines of the csv
+    between two byte offsets. Returns the number of rows, the rows of every
+    table and, with header, an empty normalized frame to create the tables
+    from.
+    """
+    with open(csv_path, "rb") as f:
+        names = pd.read_csv(f, nrows=0).columns
+        f.seek(start)
+        data = f.read(end - start)
+    df = pd.read_csv(
+        io.BytesIO(data), header=None, names=names, usecols=list(DTYPES), dtype=DTYPES
+    )
+    normalize(df)
+    return len(df), project(df), df.iloc[:0] if header else None
+
+
+def insert_tables(tables: Dict[str, pd.DataFrame], con: Connection, offset: int):
+    """
+    Bulk inserts the rows of project() with executemany, victims numbered
+    from offset. Keys that are already stored are skipped.
+    """
+    def rows(t):
+        t = t.astype(object).where(t.notna(), None)
+        return t.itertuples(index=False, name=None)
+
+    tables["vitimas"]["vitimaId"] += offset
+    tables["ocorrencias"]["vitimaId"] += offset
+    encode(tables["vitimas"], con)
+    tables["vitimas"] = tables["vitimas"][
+        ["vitimaId", "idade", "sexoId", "descendenciaId"]
+    ]
+    for name, t in tables.items():
+        columns = ", ".join(t.columns)
+        params = ", ".join("?" for _ in t.columns)
+        if name == "crimes":
+            sql = (
+                f"INSERT INTO crimes ({columns}) VALUES ({params}) "
+                "ON CONFLICT(crimeId) DO UPDATE SET desc_crime = excluded.desc_crime "
+                "WHERE desc_crime = 'Unknown'"
+            )
+        else:
+            sql = f"INSERT OR IGNORE INTO {name} ({columns}) VALUES ({params})"
+        con.executemany(sql, rows(t))
+
+
+def load_parallel(csv_path: str, con: Connection, workers: int):
+    """
+    Full import with the csv split in partitions that are parsed, normalized
+    and projected by a pool of worker processes. This process is the only
+    writer and inserts the partitions in csv order, in one transaction. At
+    most two partitions per worker are in flight, to bound memory.
+    """
+    parts = partitions(csv_path, workers)
+    logging.info(f"{len(parts)} partitions, {workers} workers")
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        offset = 0
+        for i in range(len(parts)):
+            while len(pending) < workers * 2 and i + len(pending) < len(parts):
+                start, end = parts[i + len(pending)]
+                header = i + len(pending) == 0
+                pending.append(pool.submit(transform, csv_path, start, end, header))
+            with stage("Waiting for workers") as timing:
+                n, tables, empty = pending.popleft().result()
+                timing["rows"] = n
+            if empty is not None:
+                # Creates every table exactly like the serial import does
+                write_tables(empty, con, "replace")
+            with stage("Writing tables", n):
+                insert_tables(tables, con, offset)
+            offset += n
+    con.commit()
+
+
+def main(
+    csv_path: str = CSV_PATH,
+    db_path: str = DB_PATH,
+    chunksize: Optional[int] = None,
+    incremental: bool = False,
+    migrate_only: bool = False,
+    workers: int = 1,
+):
+    """
+    Imports the csv into db_path. With a chunksize the csv is streamed and
+    only one chunk of rows is held in memory at a time. An incremental import
+    starts from the current database and only adds or updates the
+    occurrences found in the csv, keyed on DR_NO. migrate_only converts the
+    current database to the current schema without importing anything. A
+    full import without chunksize and with more than one worker runs
+    load_parallel.
+
+    The database is built in a shadow file that replaces db_path at the end,
+    so readers never see a half built database.
+    """
+    TIMINGS.clear()
+    shadow = db_path + ".tmp"
+    for path in (shadow, shadow + "-journal"):
+        if os.path.exists(path):
+            os.remove(path)
+
+    incremental = incremental or migrate_only
+    if incremental and not os.path.exists(db_path):
+        logging.warning(f"{db_path} does not exist, doing a full import")
+        incremental = False
+
+    generation = 0
+    if os.path.exists(db_path):
+        with connect(db_path) as old:
+            generation, _ = schema.generation(old)
+        old.close()
 
+    con = connect(shadow)
+    # Nothing needs to survive a crash of the import, the shadow file is
+    # thrown away and built again
+    con.execute("PRAGMA synchronous=OFF")
+    con.execute("PRAGMA journal_mode=OFF")
+    try:
+        if incremental:
+            with stage("Copying database") as timing:
+                with connect(db_path) as src:
+                    src.backup(con)
+                src.close()
+                con.execute("PRAGMA journal_mode=OFF")
+                timing["rows"] = con.execute(
+                    "SELECT COUNT() FROM ocorrencias"
+                ).fetchone()[0]
+            if schema.version(con) < schema.VERSION:
+                with stage("Migrating", timing["rows"]):
+                    migrate(con)
+                    con.commit()
+
+        if migrate_only:
+            chunks = []
+        elif workers > 1 and chunksize is None and not incremental:
+            load_parallel(csv_path, con, workers)
+            chunks = []
+        elif chunksize is None:
+            with stage("Reading csv") as timing:
+                chunks = [read_csv(csv_path)]
+                timing["rows"] = len(chunks[0])
+        else:
+            chunks = read_chunks(csv_path, chunksize)
+
+        for i, df in enumerate(chunks):
+            if chunksize is not None:
+                logging.info(f"Chunk {i}: rows {df.index[0]} to {df.index[-1]}")
+            with stage("Normalizing", len(df)):
+                normalize(df)
+            if incremental:
+                existing, new = assign_vitima_ids(df, con)
+                logging.info(f"{new} new occurrences, {existing} updated")
+                write_tables(df, con, "upsert")
+            else:
+                write_tables(df, con, "replace" if i == 0 else "append")
+            con.commit()
+        del chunks
+
+        # Indexes
+        n = con.execute("SELECT COUNT() FROM ocorrencias").fetchone()[0]
+        with stage("Creating indexes", n):
+            schema.build(
+                con,
+                rebuild=not incremental or schema.version(con) < schema.VERSION,
+            )
+
+        # Summary tables
+        with stage("Creating summary tables", n):
+            aggregates.refresh(con)
+
+        # Rollups, kept up to date by the incremental import itself
+        if not incremental:
+            with stage("Creating rollups", n):
+                rollups.build(con)
+
+        # Search indexes
+        with stage("Creating search indexes", n):
+            fts.build(con)
+
+        # Spatial index
+        with stage("Creating spatial index", n):
+            spatial.build(con)
+
+        schema.stamp(con, generation + 1)
         con.commit()
 
+        # Columnar snapshot, published along with the database
+        with stage("Writing columnar snapshot", n):
+            columnar.write(con, db_path, generation + 1)
+        if migrate_only:
+            with stage("Vacuuming", n):
+                con.execute("VACUUM")
+    finally:
+        con.close()
+
+    # The snapshot goes first, a database is never without its own
+    columnar.publish(db_path, generation + 1)
+    os.replace(shadow, db_path)
+    logging.info(f"Done! Database generation {generation + 1}")
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build data.db from the LA crime csv")
+    parser.add_argument("csv", nargs="?", default=CSV_PATH)
+    parser.add_argument("--db", default=DB_PATH)
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        help="stream the csv this many rows at a time to keep memory flat",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only add or update the occurrences of the csv in the current database",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="processes parsing the csv in a full import (default: one per core)",
+    )
+    parser.add_argument(
+        "--migrate",
+        action="store_true",
+        help="convert the current database to the current schema, without importing",
+    )
+    args = parser.parse_args()
+
     logging.basicConfig(
         level=logging.INFO,
         format="%(asctime)s - %(levelname)s - %(message)s",
         datefmt="%Y-%m-%d %H:%M:%S",
     )
-    main()
+    main(
+        args.csv,
+        args.db,
+        args.chunksize,
+        args.incremental,
+        args.migrate,
+        args.workers,
+    )
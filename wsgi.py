@@ -0,0 +1,3 @@
+# WSGI entry point for production servers. The database is connected by the
+# server once per worker, see post_worker_init in gunicorn.conf.py.
+from app import APP